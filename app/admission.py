@@ -0,0 +1,252 @@
+# app/admission.py
+"""
+Admission control in front of the upstreams (OpenSearch, reranker, LLM).
+
+Each upstream gets a concurrency limit. Requests over the limit wait in
+per-user FIFO queues that are served round-robin, so one user's burst
+can't starve everyone else; interactive traffic is always served before
+batch traffic. Rejections are fast:
+  429  this user already has ADMISSION_MAX_PER_USER requests queued
+  503  the queue is full, or the wait exceeded ADMISSION_MAX_WAIT_MS
+
+Limits are per process. The API (/query) and the chat app run as separate
+processes with separate limiters, so chat is NOT prioritized over /query
+batch traffic: interactive-before-batch only orders requests within one
+app. Size LIMIT_* so the processes' limits together fit each upstream.
+In /query, only callers with a key from ADMISSION_API_KEYS get their own
+queue and may ask for interactive priority; everyone else is queued by
+address as batch traffic.
+
+A reranker backend that limits itself (the GPU/CPU router spills instead
+of queueing) has admission_upstream = None and skips the reranker queue.
+
+    async with admission.slot("reranker", user, PRIORITY_INTERACTIVE):
+        ...
+"""
+import os
+import time
+import asyncio
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Any, AsyncIterator, Optional, Tuple
+
+from fastapi import HTTPException
+
+# -----------------------
+# Environment / Defaults
+# -----------------------
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))  # per upstream
+ADMISSION_MAX_PER_USER = int(os.getenv("ADMISSION_MAX_PER_USER", "4"))
+ADMISSION_MAX_WAIT_MS = int(os.getenv("ADMISSION_MAX_WAIT_MS", "5000"))
+# Proxies (load balancers) in front of the API that append to X-Forwarded-For;
+# the client is the entry this many places from the right. 0 = use the peer
+# (the default: without a proxy, X-Forwarded-For is whatever the client sent).
+ADMISSION_PROXY_HOPS = int(os.getenv("ADMISSION_PROXY_HOPS", "0"))
+# Comma-separated API keys whose callers are queued per key (and trusted to
+# ask for interactive priority); any other X-API-Key is ignored
+ADMISSION_API_KEYS = frozenset(
+    k.strip() for k in os.getenv("ADMISSION_API_KEYS", "").split(",") if k.strip()
+)
+UPSTREAM_LIMITS = {
+    "opensearch": int(os.getenv("LIMIT_OPENSEARCH", "16")),
+    "reranker": int(os.getenv("LIMIT_RERANKER", "4")),
+    "llm": int(os.getenv("LIMIT_LLM", "8")),
+}
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+_PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_BATCH)
+
+_WAIT_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+class AdmissionRejected(HTTPException):
+    def __init__(self, status_code: int, upstream: str, reason: str):
+        super().__init__(
+            status_code=status_code,
+            detail=f"{upstream} busy: {reason}",
+            headers={"Retry-After": "1"},
+        )
+        self.upstream = upstream
+
+
+class FairLimiter:
+    """Concurrency limit + per-user round-robin queues for one upstream."""
+
+    def __init__(
+        self,
+        name: str,
+        limit: int,
+        max_queue: int = ADMISSION_MAX_QUEUE,
+        max_per_user: int = ADMISSION_MAX_PER_USER,
+        max_wait_ms: int = ADMISSION_MAX_WAIT_MS,
+    ):
+        self.name = name
+        self.limit = max(1, limit)
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        self.max_wait = max_wait_ms / 1000.0
+        self.active = 0
+        # priority -> user -> FIFO of (future, enqueued_at); dict order is the
+        # round-robin order across users
+        self._queues: Dict[int, "OrderedDict[str, Deque[Tuple[Any, float]]]"] = {
+            p: OrderedDict() for p in _PRIORITIES
+        }
+        self._waiting = 0
+        self._admitted = 0
+        self._rejected = {429: 0, 503: 0}
+        self._wait_hist = [0] * (len(_WAIT_BUCKETS_MS) + 1)
+        self._wait_sum = 0.0
+        self._wait_max = 0.0
+
+    # ---- metrics ----
+    def _record_wait(self, seconds: float) -> None:
+        ms = seconds * 1000.0
+        self._admitted += 1
+        self._wait_hist[bisect_left(_WAIT_BUCKETS_MS, ms)] += 1
+        self._wait_sum += ms
+        self._wait_max = max(self._wait_max, ms)
+
+    def snapshot(self) -> Dict[str, Any]:
+        labels = [f"le_{b}ms" for b in _WAIT_BUCKETS_MS] + ["gt_5000ms"]
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "queued": {
+                "interactive": self._depth(PRIORITY_INTERACTIVE),
+                "batch": self._depth(PRIORITY_BATCH),
+            },
+            "admitted": self._admitted,
+            "rejected_429": self._rejected[429],
+            "rejected_503": self._rejected[503],
+            "wait_ms": {
+                "mean": self._wait_sum / self._admitted if self._admitted else 0.0,
+                "max": self._wait_max,
+                "histogram": dict(zip(labels, self._wait_hist)),
+            },
+        }
+
+    def _depth(self, priority: int) -> int:
+        return sum(len(q) for q in self._queues[priority].values())
+
+    # ---- queueing ----
+    def _reject(self, status_code: int, reason: str) -> AdmissionRejected:
+        self._rejected[status_code] += 1
+        return AdmissionRejected(status_code, self.name, reason)
+
+    def _remove(self, priority: int, user: str, fut: asyncio.Future) -> None:
+        q = self._queues[priority].get(user)
+        if q is None:
+            return
+        for item in q:
+            if item[0] is fut:
+                q.remove(item)
+                self._waiting -= 1
+                break
+        if not q:
+            del self._queues[priority][user]
+
+    def _next_waiter(self) -> Tuple[asyncio.Future, float]:
+        for p in _PRIORITIES:
+            users = self._queues[p]
+            while users:
+                user, q = users.popitem(last=False)
+                fut, t0 = q.popleft()
+                self._waiting -= 1
+                if q:
+                    users[user] = q  # back of the round-robin
+                if not fut.done():
+                    return fut, t0
+        raise LookupError
+
+    async def acquire(self, user: str, priority: int = PRIORITY_BATCH) -> None:
+        if self.active < self.limit and not self._waiting:
+            self.active += 1
+            self._record_wait(0.0)
+            return
+        if self._waiting >= self.max_queue:
+            raise self._reject(503, "queue full")
+        user_q = self._queues[priority].get(user)
+        if user_q is not None and len(user_q) >= self.max_per_user:
+            raise self._reject(429, "too many queued requests for this user")
+
+        fut = asyncio.get_running_loop().create_future()
+        t0 = time.monotonic()
+        self._queues[priority].setdefault(user, deque()).append((fut, t0))
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(fut, self.max_wait)
+        except asyncio.TimeoutError:
+            # release() may have handed us the slot just as the wait timed out
+            # (3.12+ wait_for reports the timeout anyway): keep it, or it leaks
+            if not (fut.done() and not fut.cancelled()):
+                self._remove(priority, user, fut)
+                raise self._reject(
+                    503, f"waited over {int(self.max_wait * 1000)}ms"
+                ) from None
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()  # slot was handed over just as the caller went away
+            else:
+                self._remove(priority, user, fut)
+            raise
+        self._record_wait(time.monotonic() - t0)
+
+    def release(self) -> None:
+        # Hand the slot straight to the next waiter so a newcomer can't jump the queue
+        try:
+            fut, _ = self._next_waiter()
+        except LookupError:
+            self.active -= 1
+            return
+        fut.set_result(None)
+
+    @asynccontextmanager
+    async def slot(
+        self, user: str, priority: int = PRIORITY_BATCH
+    ) -> AsyncIterator[None]:
+        await self.acquire(user, priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+def client_address(forwarded_for: Optional[str], peer: Optional[str]) -> str:
+    """
+    The caller's address behind ADMISSION_PROXY_HOPS proxies. Entries left
+    of those are client-supplied, so they're never trusted.
+    """
+    hops = [h.strip() for h in (forwarded_for or "").split(",") if h.strip()]
+    if ADMISSION_PROXY_HOPS > 0 and len(hops) >= ADMISSION_PROXY_HOPS:
+        return hops[-ADMISSION_PROXY_HOPS]
+    return peer or "unknown"
+
+
+class Admission:
+    """One FairLimiter per upstream; a no-op when ADMISSION_ENABLED is false."""
+
+    def __init__(
+        self, limits: Dict[str, int] = UPSTREAM_LIMITS, enabled: bool = ADMISSION_ENABLED
+    ):
+        self.enabled = enabled
+        self.limiters = {name: FairLimiter(name, n) for name, n in limits.items()}
+
+    @asynccontextmanager
+    async def slot(
+        self, upstream: Optional[str], user: str, priority: int = PRIORITY_BATCH
+    ) -> AsyncIterator[None]:
+        if not self.enabled or upstream is None:
+            yield
+            return
+        async with self.limiters[upstream].slot(user, priority):
+            yield
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "upstreams": {name: lim.snapshot() for name, lim in self.limiters.items()},
+        }
+
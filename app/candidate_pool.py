@@ -0,0 +1,117 @@
+# app/candidate_pool.py
+"""
+Per-thread candidate pool for follow-up turns.
+
+After a search, the decoded candidates and their rerank ranking are kept in
+the chat session. When the next query overlaps strongly with the pooled
+one, we skip the full OpenSearch search:
+  reselect  same query terms: reuse the cached ranking, no search, no rerank
+  rerank    strong overlap: rerank the pool, topping it up with a small
+            supplementary search when the new query brings new terms
+
+The pool is a plain dict (session-friendly) capped by POOL_MAX_CANDIDATES
+and POOL_MAX_CHARS of passage text.
+"""
+import os
+from typing import List, Dict, Any, Optional, Set
+
+from .local_index import tokenize
+
+# -----------------------
+# Environment / Defaults
+# -----------------------
+POOL_REUSE_ENABLED = os.getenv("POOL_REUSE_ENABLED", "true").lower() == "true"
+POOL_MIN_OVERLAP = float(os.getenv("POOL_MIN_OVERLAP", "0.5"))  # query-term Jaccard
+POOL_MAX_CANDIDATES = int(os.getenv("POOL_MAX_CANDIDATES", "200"))
+POOL_MAX_CHARS = int(os.getenv("POOL_MAX_CHARS", "400000"))  # ~per-thread memory cap
+POOL_TOPUP_K = int(os.getenv("POOL_TOPUP_K", "10"))
+
+# Process-wide counters (how often follow-ups reused the pool)
+POOL_STATS = {"turns": 0, "fresh": 0, "reselected": 0, "reranked": 0, "topups": 0}
+
+
+def _terms(query: str) -> Set[str]:
+    return set(tokenize(query))
+
+
+def query_overlap(a: str, b: str) -> float:
+    ta, tb = _terms(a), _terms(b)
+    if not ta or not tb:
+        return 0.0
+    return len(ta & tb) / len(ta | tb)
+
+
+def plan_reuse(
+    pool: Optional[Dict[str, Any]], query: str, top_k: int
+) -> Optional[str]:
+    """"reselect", "rerank", or None (run a fresh search)."""
+    if not POOL_REUSE_ENABLED or not pool or not pool.get("candidates"):
+        return None
+    if _terms(query) == _terms(pool["query"]) and len(pool["ranking"]) >= top_k:
+        return "reselect"
+    if query_overlap(query, pool["query"]) >= POOL_MIN_OVERLAP:
+        return "rerank"
+    return None
+
+
+def needs_topup(pool: Dict[str, Any], query: str, top_k: int) -> bool:
+    """New query terms the pool wasn't searched for, or too few candidates left."""
+    new_terms = _terms(query) - _terms(pool["query"])
+    return bool(new_terms) or len(pool["candidates"]) < top_k
+
+
+def _key(d: Dict[str, Any]) -> str:
+    return str(d.get("pmid") or d.get("id"))
+
+
+def merge_candidates(
+    pool: List[Dict[str, Any]], extra: List[Dict[str, Any]]
+) -> List[Dict[str, Any]]:
+    """Append supplementary-search hits that aren't already pooled."""
+    seen = {_key(d) for d in pool}
+    return pool + [d for d in extra if _key(d) not in seen]
+
+
+def build_pool(
+    query: str, candidates: List[Dict[str, Any]], reranked: List[Dict[str, Any]]
+) -> Dict[str, Any]:
+    """
+    Pool for the session: ranked candidates first (so trimming drops the
+    least useful ones), then the rest, within the count/char caps.
+    """
+    ranked_keys = [_key(d) for d in reranked]
+    ranked_set = set(ranked_keys)
+    by_key = {_key(d): d for d in candidates}
+    for d in reranked:
+        by_key.setdefault(_key(d), d)
+    order = ranked_keys + [k for k in by_key if k not in ranked_set]
+
+    kept: List[Dict[str, Any]] = []
+    chars = 0
+    for k in order[:POOL_MAX_CANDIDATES]:
+        d = by_key[k]
+        size = len(d.get("text") or "")
+        if chars + size > POOL_MAX_CHARS:
+            break
+        chars += size
+        kept.append(d)
+
+    return {
+        "query": query,
+        "candidates": kept,
+        "ranking": [{"key": _key(d), "score": d.get("score")} for d in reranked],
+        "chars": chars,
+    }
+
+
+def reselect(pool: Dict[str, Any], top_k: int) -> List[Dict[str, Any]]:
+    """Rebuild the cached rerank result (same query terms) without calling anything."""
+    by_key = {_key(d): d for d in pool["candidates"]}
+    out: List[Dict[str, Any]] = []
+    for r in pool["ranking"]:
+        d = by_key.get(r["key"])
+        if d is not None:
+            out.append({**d, "score": r["score"]})
+        if len(out) >= top_k:
+            break
+    return out
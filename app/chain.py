@@ -1,6 +1,7 @@
 # app/chain.py
 import os
-from typing import List, Dict, Any, Optional
+import re
+from typing import List, Dict, Any, Optional, Callable
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_google_genai import ChatGoogleGenerativeAI
@@ -21,6 +22,31 @@ to search, output a single line exactly in this format:
 READY: <final concise query>
 Otherwise, reply normally to continue clarifying."""
 
+# --- Model routing ---
+# Cheap features decide whether a question needs the strong model. Anything
+# that asks for synthesis/comparison, or brings a lot of context, goes strong;
+# short lookups go to the fast model.
+# Defaults are measured against what an answer turn sees: TOP_K snippets of
+# at most CONTEXT_CHARS_PER_DOC chars. More sources than TOP_K (only /query
+# callers can ask for that) goes strong, and so does a full context whose
+# snippets average over 3/4 of the cap, i.e. mostly truncated long abstracts.
+_TOP_K = int(os.getenv("TOP_K", "10"))
+_HEADER_CHARS = 150  # "[n] title (PMID: …) url" line
+ROUTE_FAST_MAX_SOURCES = int(os.getenv("ROUTE_FAST_MAX_SOURCES") or _TOP_K)
+ROUTE_FAST_MAX_CONTEXT_CHARS = int(
+    os.getenv("ROUTE_FAST_MAX_CONTEXT_CHARS")
+    or _TOP_K
+    * (int(os.getenv("CONTEXT_CHARS_PER_DOC", "1200")) * 3 // 4 + _HEADER_CHARS)
+)
+ROUTE_FAST_MAX_QUESTION_WORDS = int(os.getenv("ROUTE_FAST_MAX_QUESTION_WORDS", "40"))
+
+_COMPLEX_CUES = re.compile(
+    r"\b(compare|comparison|versus|vs\.?|differen\w*|contrast|mechanism\w*|"
+    r"why|how does|how do|trade-?offs?|pros and cons|summari[sz]e|review|"
+    r"synthes\w*|evidence for|evidence against|controvers\w*|meta-analys\w*)\b",
+    re.IGNORECASE,
+)
+
 # --- Prompt templates ---
 # Main RAG prompt includes compact chat history + the retrieval context
 PROMPT = ChatPromptTemplate.from_template(
@@ -103,3 +129,51 @@ def render_context(docs: List[Dict[str, Any]]) -> str:
         lines.append(f"{header}\n{text}\n")
 
     return "\n".join(lines)
+
+
+def route_features(
+    question: str, docs: Optional[List[Dict[str, Any]]] = None, context: str = ""
+) -> Dict[str, Any]:
+    """The cheap signals choose_route looks at (also handy for logging)."""
+    return {
+        "question_words": len((question or "").split()),
+        "complex_cue": bool(_COMPLEX_CUES.search(question or "")),
+        "n_sources": len(docs or []),
+        "context_chars": len(context or ""),
+    }
+
+
+def choose_route(
+    question: str, docs: Optional[List[Dict[str, Any]]] = None, context: str = ""
+) -> str:
+    """
+    Returns "fast" or "strong" for an answer turn. The clarifier always
+    uses "fast" and doesn't go through here.
+    """
+    f = route_features(question, docs, context)
+    if (
+        f["complex_cue"]
+        or f["n_sources"] > ROUTE_FAST_MAX_SOURCES
+        or f["context_chars"] > ROUTE_FAST_MAX_CONTEXT_CHARS
+        or f["question_words"] > ROUTE_FAST_MAX_QUESTION_WORDS
+    ):
+        return "strong"
+    return "fast"
+
+
+def build_routed_chains(
+    llms: Dict[str, ChatGoogleGenerativeAI],
+    builder: Callable[..., Any] = build_streaming_chain,
+    **kwargs,
+) -> Dict[str, Any]:
+    """
+    One answer chain per route, e.g. build_routed_chains(get_llms()).
+    Routes that share an LLM share the chain.
+    """
+    built: Dict[int, Any] = {}
+    chains: Dict[str, Any] = {}
+    for route, llm in llms.items():
+        if id(llm) not in built:
+            built[id(llm)] = builder(llm, **kwargs)
+        chains[route] = built[id(llm)]
+    return chains
@@ -1,16 +1,32 @@
 # app/clients.py
 import os
+import logging
 import httpx
 import boto3
 from urllib.parse import urlparse
-from typing import List
+from typing import List, Dict, Optional, TYPE_CHECKING
 from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth
 from langchain_google_genai import ChatGoogleGenerativeAI
+from .serialization import FastJSONSerializer
+from .rerankers import (
+    RERANKER_CPU_SCORER,
+    RerankerBackend,
+    HttpReranker,
+    CpuReranker,
+    RoutingReranker,
+)
+
+if TYPE_CHECKING:
+    from .local_index import ReloadingIndex
 
 AWS_REGION = os.getenv("AWS_REGION", "us-east-1")
 OPENSEARCH_ENDPOINT_RAW = os.getenv("OPENSEARCH_ENDPOINT")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-pro")
+GEMINI_FAST_MODEL = os.getenv("GEMINI_FAST_MODEL", "gemini-1.5-flash")
+# When false, every route uses GEMINI_MODEL (the pre-routing behavior)
+MODEL_ROUTING = os.getenv("MODEL_ROUTING", "true").lower() == "true"
+RERANKER_BACKEND = os.getenv("RERANKER_BACKEND", "http")  # http | cpu | router
 
 # Tunables
 OS_TIMEOUT = int(os.getenv("OPENSEARCH_TIMEOUT", "20"))
@@ -88,6 +104,7 @@ def get_os_client() -> OpenSearch:
         max_retries=OS_MAX_RETRIES,
         retry_on_timeout=OS_RETRY_ON_TIMEOUT,
         retry_on_status=OS_RETRY_ON_STATUS,
+        serializer=FastJSONSerializer(),  # orjson-backed, same bytes on the wire
     )
 
     # Fast fail if domain not reachable. If your domain blocks HEAD /, you can remove this.
@@ -102,19 +119,22 @@ def get_os_client() -> OpenSearch:
     return client
 
 
-def get_llm() -> ChatGoogleGenerativeAI:
+def get_llm(
+    model: Optional[str] = None, max_output_tokens: Optional[int] = None
+) -> ChatGoogleGenerativeAI:
     api_key = GEMINI_API_KEY
     if not api_key:
         raise RuntimeError("Set GEMINI_API_KEY env var")
 
     # Optional: read common generation params from env
     temperature = float(os.getenv("GEMINI_TEMPERATURE", "0.2"))
-    max_output_tokens = int(os.getenv("GEMINI_MAX_TOKENS", "1024"))
+    if max_output_tokens is None:
+        max_output_tokens = int(os.getenv("GEMINI_MAX_TOKENS", "1024"))
 
     # Note: ChatGoogleGenerativeAI supports .stream() in LangChain.
     # The 'streaming' kw is accepted in recent LangChain versions; safe to omit if yours is older.
     return ChatGoogleGenerativeAI(
-        model=GEMINI_MODEL,
+        model=model or GEMINI_MODEL,
         api_key=api_key,
         temperature=temperature,
         max_output_tokens=max_output_tokens,
@@ -122,7 +142,70 @@ def get_llm() -> ChatGoogleGenerativeAI:
     )
 
 
+def get_llms() -> Dict[str, ChatGoogleGenerativeAI]:
+    """
+    One LLM per route (see chain.choose_route), each with its own output cap:
+      fast:   GEMINI_FAST_MODEL, GEMINI_FAST_MAX_TOKENS (clarifier, simple lookups)
+      strong: GEMINI_MODEL, GEMINI_MAX_TOKENS (multi-source synthesis)
+    """
+    strong = get_llm()
+    if not MODEL_ROUTING:
+        return {"fast": strong, "strong": strong}
+    fast = get_llm(
+        GEMINI_FAST_MODEL, int(os.getenv("GEMINI_FAST_MAX_TOKENS", "512"))
+    )
+    return {"fast": fast, "strong": strong}
+
+
 def get_http_client() -> httpx.AsyncClient:
     # Used for the reranker (HTTP/2 can improve perf if the service supports it)
     timeout = float(os.getenv("HTTPX_TIMEOUT", "120"))
     return httpx.AsyncClient(timeout=timeout, http2=True)
+
+
+def _check_cpu_scorer() -> None:
+    # These rankings reach users, so the CPU model must be chosen on purpose
+    if not RERANKER_CPU_SCORER:
+        raise RuntimeError(
+            f"RERANKER_BACKEND={RERANKER_BACKEND} needs RERANKER_CPU_SCORER "
+            "(e.g. cross-encoder:cross-encoder/ms-marco-MiniLM-L-6-v2)"
+        )
+    if RERANKER_CPU_SCORER == "lexical":
+        logging.getLogger(__name__).warning(
+            "RERANKER_CPU_SCORER=lexical: CPU rankings are term overlap only, "
+            "not a cross-encoder"
+        )
+
+
+def get_reranker() -> RerankerBackend:
+    """
+    http:   remote GPU service only (default)
+    cpu:    local process-pool scoring only (RERANKER_CPU_SCORER)
+    router: GPU, spilling to CPU past RERANKER_MAX_INFLIGHT or on errors
+    """
+    if RERANKER_BACKEND == "http":
+        return HttpReranker()
+    if RERANKER_BACKEND in ("cpu", "router"):
+        _check_cpu_scorer()
+    if RERANKER_BACKEND == "cpu":
+        return CpuReranker()
+    if RERANKER_BACKEND == "router":
+        return RoutingReranker(HttpReranker(), CpuReranker())
+    raise RuntimeError(f"Unknown RERANKER_BACKEND: {RERANKER_BACKEND!r}")
+
+
+def get_local_index() -> Optional["ReloadingIndex"]:
+    """
+    Open the local hot-set index if LOCAL_INDEX_PATH is set, else None.
+    It picks up rebuilds (`build --incremental` too) without a restart.
+    """
+    path = os.getenv("LOCAL_INDEX_PATH")
+    if not path:
+        return None
+    from .local_index import ReloadingIndex
+
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        raise RuntimeError(
+            f"LOCAL_INDEX_PATH={path} has no index; run `python -m app.local_index build`"
+        )
+    return ReloadingIndex(path)
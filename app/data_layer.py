@@ -0,0 +1,296 @@
+# app/data_layer.py
+"""
+Write-behind Chainlit persistence on top of DynamoDBDataLayer.
+
+- Step/message writes are queued, coalesced per step id (a create followed by
+  updates becomes one write) and flushed in batches by a background task.
+  The parent's boto3 calls are blocking, so each write runs in a worker
+  thread and DynamoDB latency stays off the event loop. Failed writes are
+  re-queued for the next flush, up to WRITE_BEHIND_MAX_RETRIES times.
+- Step outputs larger than OFFLOAD_MIN_BYTES are gzipped to the storage
+  client (S3) and DynamoDB keeps only a compact view (ids, scores, titles)
+  plus the object key. get_thread doesn't fetch them: each such step gets an
+  element whose url (OFFLOAD_URL) serves the payload when the UI opens it.
+- Queued writes live in memory only. close() drains them on shutdown, but a
+  crash loses what hadn't been written yet: up to WRITE_BEHIND_INTERVAL_MS
+  (or WRITE_BEHIND_BATCH steps) of recent writes, plus failed writes still
+  waiting for a retry.
+
+Works against local stand-ins: pass a boto3 client pointed at DynamoDB Local
+and a storage client pointed at MinIO/LocalStack (see cl_app.init_data_layer).
+"""
+import os
+import gzip
+import asyncio
+import contextvars
+from typing import Dict, Any, List, Optional, Tuple
+
+import httpx
+from chainlit.logger import logger
+from chainlit.data.dynamodb import DynamoDBDataLayer
+from chainlit.data.utils import queue_until_user_message
+
+from .serialization import dumps, loads
+
+# -----------------------
+# Environment / Defaults
+# -----------------------
+WRITE_BEHIND_BATCH = int(os.getenv("WRITE_BEHIND_BATCH", "25"))
+WRITE_BEHIND_INTERVAL_MS = int(os.getenv("WRITE_BEHIND_INTERVAL_MS", "250"))
+WRITE_BEHIND_MAX_RETRIES = int(os.getenv("WRITE_BEHIND_MAX_RETRIES", "3"))
+OFFLOAD_MIN_BYTES = int(os.getenv("OFFLOAD_MIN_BYTES", "16384"))
+# Route that serves offloaded outputs (see cl_app.offloaded_output)
+OFFLOAD_URL = "/offloaded/{thread_id}/{step_id}"
+
+_COMPACT_KEYS = ("id", "pmid", "score", "title")
+
+
+def compact_payload(obj: Any) -> Any:
+    """
+    Reduce candidate-like dicts (anything with an "id") to id/pmid/score/title,
+    recursing through lists and dicts. Other values pass through unchanged.
+    """
+    if isinstance(obj, list):
+        return [compact_payload(v) for v in obj]
+    if isinstance(obj, dict):
+        if "id" in obj:
+            return {k: obj[k] for k in _COMPACT_KEYS if k in obj}
+        return {k: compact_payload(v) for k, v in obj.items()}
+    return obj
+
+
+class WriteBehindDataLayer(DynamoDBDataLayer):
+    def __init__(
+        self,
+        *args: Any,
+        batch_size: int = WRITE_BEHIND_BATCH,
+        flush_interval_ms: int = WRITE_BEHIND_INTERVAL_MS,
+        offload_min_bytes: int = OFFLOAD_MIN_BYTES,
+        max_retries: int = WRITE_BEHIND_MAX_RETRIES,
+        **kwargs: Any,
+    ):
+        super().__init__(*args, **kwargs)
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.offload_min_bytes = offload_min_bytes
+        self.max_retries = max_retries
+        # step id -> (merged step dict, "create" | "update", context of the
+        # caller, failed attempts so far)
+        self._pending: Dict[
+            str, Tuple[Dict[str, Any], str, contextvars.Context, int]
+        ] = {}
+        self._wake = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._flusher: Optional[asyncio.Task] = None
+        self.stats = {
+            "queued": 0,
+            "coalesced": 0,
+            "written": 0,
+            "retried": 0,
+            "dropped": 0,
+            "offloaded": 0,
+            "offloaded_bytes": 0,
+        }
+
+    # ---- queueing ----
+    def _enqueue(
+        self,
+        step_dict: Dict[str, Any],
+        op: str,
+        ctx: Optional[contextvars.Context] = None,
+        attempts: int = 0,
+    ) -> None:
+        step_id = step_dict["id"]
+        prev = self._pending.get(step_id)
+        if prev is not None:
+            # Keep the first op: create + update is still a create. A failed
+            # (older) write re-queued behind a newer one merges underneath it.
+            if attempts:
+                step_dict, op = {**step_dict, **prev[0]}, op
+            else:
+                step_dict, op, attempts = {**prev[0], **step_dict}, prev[1], prev[3]
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["queued"] += 1
+        # The parent's writes consult the Chainlit session context, so keep the caller's
+        if ctx is None:
+            ctx = contextvars.copy_context()
+        self._pending[step_id] = (step_dict, op, ctx, attempts)
+
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._run())
+        if len(self._pending) >= self.batch_size:
+            self._wake.set()
+
+    @queue_until_user_message()
+    async def create_step(self, step_dict):
+        self._enqueue(dict(step_dict), "create")
+
+    @queue_until_user_message()
+    async def update_step(self, step_dict):
+        self._enqueue(dict(step_dict), "update")
+
+    async def delete_step(self, step_id: str):
+        self._pending.pop(step_id, None)
+        await super().delete_step(step_id)
+
+    # ---- flushing ----
+    async def _run(self) -> None:
+        while self._pending:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        """
+        Write everything queued so far, batch_size steps at a time. Writes
+        that fail are re-queued for the next flush, not retried in this one.
+        """
+        async with self._flush_lock:
+            ids = list(self._pending)
+            for i in range(0, len(ids), self.batch_size):
+                batch = [
+                    self._pending.pop(step_id)
+                    for step_id in ids[i : i + self.batch_size]
+                    if step_id in self._pending  # may have been deleted meanwhile
+                ]
+                await asyncio.gather(*(self._write(*item) for item in batch))
+
+    def _run_parent(
+        self, step_dict: Dict[str, Any], op: str, ctx: contextvars.Context
+    ) -> None:
+        # Worker thread: the parent coroutine blocks on boto3, so it gets its
+        # own loop here instead of stalling the app's.
+        parent = (
+            DynamoDBDataLayer.create_step
+            if op == "create"
+            else DynamoDBDataLayer.update_step
+        )
+        ctx.run(asyncio.run, parent(self, step_dict))
+
+    async def _write(
+        self,
+        step_dict: Dict[str, Any],
+        op: str,
+        ctx: contextvars.Context,
+        attempts: int,
+    ) -> None:
+        try:
+            written = await self._offload(step_dict)
+            await asyncio.to_thread(self._run_parent, written, op, ctx.copy())
+            self.stats["written"] += 1
+        except Exception as e:
+            attempts += 1
+            if attempts > self.max_retries:
+                self.stats["dropped"] += 1
+                logger.error(
+                    f"Write-behind step {step_dict.get('id')} dropped after "
+                    f"{attempts} attempts: {e}"
+                )
+                return
+            self.stats["retried"] += 1
+            logger.warning(f"Write-behind step {step_dict.get('id')} failed: {e}")
+            # The original, not the compact view: re-offloading that would
+            # overwrite the full payload in S3
+            self._enqueue(step_dict, op, ctx, attempts)
+
+    # ---- payload offload ----
+    @staticmethod
+    def offload_key(step_dict: Dict[str, Any]) -> str:
+        return f"threads/{step_dict.get('threadId')}/steps/{step_dict['id']}.json.gz"
+
+    async def _offload(self, step_dict: Dict[str, Any]) -> Dict[str, Any]:
+        output = step_dict.get("output")
+        storage = getattr(self, "storage_provider", None)
+        if storage is None or not isinstance(output, str):
+            return step_dict
+        raw = output.encode("utf-8")
+        if len(raw) < self.offload_min_bytes:
+            return step_dict
+
+        key = self.offload_key(step_dict)
+        await storage.upload_file(
+            object_key=key,
+            data=gzip.compress(raw, compresslevel=6),
+            mime="application/gzip",
+            overwrite=True,
+        )
+        try:
+            view = compact_payload(loads(raw))
+        except ValueError:
+            view = {"preview": output[:1000]}
+        if not isinstance(view, dict):
+            view = {"value": view}
+        view["offloaded"] = {"key": key, "bytes": len(raw)}
+
+        self.stats["offloaded"] += 1
+        self.stats["offloaded_bytes"] += len(raw)
+        return {**step_dict, "output": dumps(view).decode("utf-8")}
+
+    async def load_offloaded(self, key: str) -> Any:
+        """Fetch and decode a payload written by _offload."""
+        storage = getattr(self, "storage_provider", None)
+        if storage is None:
+            raise RuntimeError("No storage provider configured")
+        url = await storage.get_read_url(key)
+        async with httpx.AsyncClient() as client:
+            r = await client.get(url)
+            r.raise_for_status()
+        return loads(gzip.decompress(r.content))
+
+    @staticmethod
+    def offloaded_element(
+        thread_id: str, step: Dict[str, Any]
+    ) -> Optional[Dict[str, Any]]:
+        """An element pointing at the step's offloaded output, if it has one."""
+        output = step.get("output")
+        if not isinstance(output, str) or '"offloaded"' not in output:
+            return None
+        try:
+            view = loads(output)
+        except ValueError:
+            return None
+        if not isinstance(view, dict) or not isinstance(view.get("offloaded"), dict):
+            return None
+        return {
+            "id": f"{step['id']}-offloaded",
+            "threadId": thread_id,
+            "forId": step["id"],
+            "type": "text",
+            "name": "Full output",
+            "display": "inline",
+            "language": "json",
+            "mime": "application/json",
+            "url": OFFLOAD_URL.format(thread_id=thread_id, step_id=step["id"]),
+        }
+
+    # ---- reads see queued writes ----
+    async def get_thread(self, thread_id: str):
+        await self.flush()
+        thread = await super().get_thread(thread_id)
+        if not thread:
+            return thread
+        # Offloaded outputs stay in S3 until their element is opened
+        elements = list(thread.get("elements") or [])
+        for step in thread.get("steps") or []:
+            element = self.offloaded_element(thread_id, step)
+            if element is not None:
+                elements.append(element)
+        thread["elements"] = elements
+        return thread
+
+    async def close(self) -> None:
+        # The first flush also waits out one already in progress; failed
+        # writes are re-queued, so keep going until they land or drop
+        await self.flush()
+        while self._pending:
+            await self.flush()
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        parent_close = getattr(super(), "close", None)
+        if parent_close is not None:
+            await parent_close()
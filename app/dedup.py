@@ -0,0 +1,183 @@
+# app/dedup.py
+"""
+Collapse duplicate retrieval candidates before they reach the reranker.
+
+Two candidates are duplicates when they share a PMID, have identical
+normalized text, or have estimated shingle Jaccard similarity >= threshold
+(preprint/published pairs, re-ingested copies). Near-duplicates are found
+with one-permutation MinHash (a single hash per shingle, binned) plus LSH
+banding, so the cost is linear in total text length rather than quadratic
+in candidates.
+"""
+import os
+import sys
+import time
+from typing import List, Dict, Any, Callable, Tuple
+
+from .local_index import tokenize
+
+# -----------------------
+# Environment / Defaults
+# -----------------------
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "true").lower() == "true"
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.8"))
+DEDUP_SHINGLE = int(os.getenv("DEDUP_SHINGLE", "3"))  # words per shingle
+
+_BINS = 64  # signature length (power of two)
+_BANDS = 16  # LSH bands of _BINS // _BANDS rows each
+_EMPTY = sys.maxsize
+
+
+def _signature(words: List[str], shingle: int) -> List[int]:
+    """One-permutation MinHash: min shingle hash per bin."""
+    sig = [_EMPTY] * _BINS
+    mask = _BINS - 1
+    n = max(1, len(words) - shingle + 1)
+    for i in range(n):
+        h = hash(tuple(words[i : i + shingle])) & sys.maxsize
+        b = h & mask
+        if h < sig[b]:
+            sig[b] = h
+    return sig
+
+
+def _similarity(a: List[int], b: List[int]) -> float:
+    """Estimated Jaccard: agreement over bins that are non-empty in either signature."""
+    same = total = 0
+    for x, y in zip(a, b):
+        if x == _EMPTY and y == _EMPTY:
+            continue
+        total += 1
+        same += x == y
+    return same / total if total else 0.0
+
+
+def _rank_key(d: Dict[str, Any], pos: int) -> Tuple[float, int, int, int]:
+    # Best representative: highest retrieval score, then has PMID/title, then earliest
+    score = d.get("score")
+    return (
+        score if isinstance(score, (int, float)) else float("-inf"),
+        1 if d.get("pmid") else 0,
+        1 if d.get("title") else 0,
+        -pos,
+    )
+
+
+def collapse_duplicates(
+    candidates: List[Dict[str, Any]],
+    threshold: float = DEDUP_THRESHOLD,
+    shingle: int = DEDUP_SHINGLE,
+) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Group exact (PMID / identical text) and near-duplicate candidates and
+    keep the best one per group, in its original position.
+    Returns (kept, removed_count).
+    """
+    n = len(candidates)
+    if n < 2:
+        return list(candidates), 0
+
+    parent = list(range(n))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(i: int, j: int) -> None:
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+
+    exact: Dict[Any, int] = {}
+    buckets: Dict[Tuple[int, Tuple[int, ...]], List[int]] = {}
+    sigs: List[List[int]] = []
+    rows = _BINS // _BANDS
+
+    for i, d in enumerate(candidates):
+        words = tokenize(d.get("text") or "")
+        keys = [("text", " ".join(words))]
+        if d.get("pmid"):
+            keys.append(("pmid", str(d["pmid"])))
+        for key in keys:
+            if key in exact:
+                union(i, exact[key])
+            else:
+                exact[key] = i
+
+        sig = _signature(words, shingle)
+        sigs.append(sig)
+        for band in range(_BANDS):
+            rows_sig = tuple(sig[band * rows : (band + 1) * rows])
+            if all(v == _EMPTY for v in rows_sig):
+                continue
+            bucket = buckets.setdefault((band, rows_sig), [])
+            for j in bucket:
+                if find(i) != find(j) and _similarity(sig, sigs[j]) >= threshold:
+                    union(i, j)
+            bucket.append(i)
+
+    best: Dict[int, int] = {}
+    for i in range(n):
+        root = find(i)
+        cur = best.get(root)
+        if cur is None or _rank_key(candidates[i], i) > _rank_key(
+            candidates[cur], cur
+        ):
+            best[root] = i
+
+    kept_idx = sorted(best.values())
+    return [candidates[i] for i in kept_idx], n - len(kept_idx)
+
+
+def search_deduped(
+    search: Callable[..., List[Dict[str, Any]]], *args: Any
+) -> Tuple[List[Dict[str, Any]], int, int]:
+    """
+    Run `search(*args)` and collapse duplicates (when DEDUP_ENABLED) in one
+    call, so both can go to a worker thread together; collapsing is CPU-bound
+    (tens of ms at k=200). Returns (kept, found, removed_count).
+    """
+    raw = search(*args)
+    if not DEDUP_ENABLED:
+        return raw, len(raw), 0
+    kept, removed = collapse_duplicates(raw)
+    return kept, len(raw), removed
+
+
+if __name__ == "__main__":
+    # Rough timing at k=200: python -m app.dedup
+    import random
+
+    rng = random.Random(0)
+    vocab = [f"w{i}" for i in range(5000)]
+    base = [
+        {
+            "id": str(i),
+            "pmid": str(i),
+            "score": rng.random(),
+            "text": " ".join(rng.choices(vocab, k=220)),
+        }
+        for i in range(150)
+    ]
+    dupes = []
+    for i in range(50):
+        src = base[rng.randrange(len(base))]
+        words = src["text"].split()
+        words[rng.randrange(len(words))] = "edited"
+        dupes.append(
+            {"id": f"d{i}", "pmid": None, "score": rng.random(), "text": " ".join(words)}
+        )
+    cands = base + dupes
+    rng.shuffle(cands)
+
+    runs = 50
+    t0 = time.perf_counter()
+    for _ in range(runs):
+        kept, removed = collapse_duplicates(cands)
+    per = (time.perf_counter() - t0) / runs
+    print(
+        f"k={len(cands)} removed={removed} "
+        f"{per * 1000:.2f}ms/call {per / len(cands) * 1e6:.1f}us/candidate"
+    )
@@ -0,0 +1,197 @@
+# app/deep_retrieval.py
+"""
+Deep retrieval: page through OpenSearch (point-in-time + search_after) and
+rerank each page while the next one is being fetched, keeping only a
+running top_k. Stops once `patience` consecutive pages fail to change the
+top_k, or the candidate budget is spent.
+
+Assumes reranker scores are comparable across calls (true for a
+cross-encoder, which scores each pair independently), so the run is pinned
+to one backend and pages that come back unranked are never merged.
+"""
+import os
+import asyncio
+from typing import List, Dict, Any, Optional, Tuple
+
+import anyio
+import httpx
+from fastapi import HTTPException
+from opensearchpy import OpenSearch  # type: ignore
+
+from .retrieval import OPENSEARCH_INDEX, search_body, _hit_to_candidate
+from .rerankers import RerankerBackend
+from .dedup import collapse_duplicates, DEDUP_ENABLED
+
+# -----------------------
+# Environment / Defaults
+# -----------------------
+DEEP_PAGE_SIZE = int(os.getenv("DEEP_PAGE_SIZE", "100"))
+DEEP_MAX_K = int(os.getenv("DEEP_MAX_K", "5000"))  # hard cap on candidates per query
+DEEP_PATIENCE = int(os.getenv("DEEP_PATIENCE", "2"))  # non-improving pages before stopping
+DEEP_PIT_KEEP_ALIVE = os.getenv("DEEP_PIT_KEEP_ALIVE", "1m")
+# Tie-breaker so search_after has a total order; any unique sortable field works
+DEEP_TIEBREAK_FIELD = os.getenv("DEEP_TIEBREAK_FIELD", "_id")
+
+
+# -----------------------
+# Paging
+# -----------------------
+def open_pit(os_client: OpenSearch) -> Optional[str]:
+    """
+    Open a point-in-time so pages see one consistent snapshot. Returns None
+    when the domain doesn't support PIT; paging then uses plain search_after.
+    """
+    try:
+        res = os_client.create_pit(
+            index=OPENSEARCH_INDEX, params={"keep_alive": DEEP_PIT_KEEP_ALIVE}
+        )
+        return res.get("pit_id")
+    except Exception:
+        return None
+
+
+def close_pit(os_client: OpenSearch, pit_id: Optional[str]) -> None:
+    if not pit_id:
+        return
+    try:
+        os_client.delete_pit(body={"pit_id": [pit_id]})
+    except Exception:
+        pass  # expires on its own after keep_alive
+
+
+def fetch_page(
+    os_client: OpenSearch,
+    query: str,
+    size: int,
+    search_after: Optional[List[Any]] = None,
+    pit_id: Optional[str] = None,
+) -> Tuple[List[Dict[str, Any]], Optional[List[Any]]]:
+    """
+    Fetch one page of candidates. Returns (candidates, cursor); cursor is
+    None when the result set is exhausted.
+    """
+    body = search_body(query, size)
+    body["sort"] = [{"_score": "desc"}, {DEEP_TIEBREAK_FIELD: "asc"}]
+    if search_after:
+        body["search_after"] = search_after
+
+    try:
+        if pit_id:
+            body["pit"] = {"id": pit_id, "keep_alive": DEEP_PIT_KEEP_ALIVE}
+            res = os_client.search(body=body)
+        else:
+            res = os_client.search(index=OPENSEARCH_INDEX, body=body)
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"OpenSearch error: {e}")
+
+    hits = res.get("hits", {}).get("hits", [])
+    out: List[Dict[str, Any]] = []
+    for h in hits:
+        cand = _hit_to_candidate(h)
+        if cand is not None:
+            out.append(cand)
+    cursor = hits[-1].get("sort") if len(hits) == size else None
+    return out, cursor
+
+
+# -----------------------
+# Pipeline
+# -----------------------
+def _merge_top(
+    top: List[Dict[str, Any]], ranked: List[Dict[str, Any]], top_k: int
+) -> List[Dict[str, Any]]:
+    merged = top + ranked
+    merged.sort(key=lambda d: d.get("score") or 0.0, reverse=True)
+    return merged[:top_k]
+
+
+async def deep_retrieve_and_rerank(
+    os_client: OpenSearch,
+    reranker: RerankerBackend,
+    http: Optional[httpx.AsyncClient],
+    query: str,
+    top_k: int,
+    max_candidates: int = DEEP_MAX_K,
+    page_size: int = DEEP_PAGE_SIZE,
+    patience: int = DEEP_PATIENCE,
+) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Returns (top_k reranked passages, stats). Memory stays at one page plus
+    the running top_k (and the ids seen so far, for cross-page dedup).
+    """
+    max_candidates = max(1, min(max_candidates, DEEP_MAX_K))
+    page_size = max(1, min(page_size, max_candidates))
+    stats: Dict[str, Any] = {
+        "pages": 0,
+        "fetched": 0,
+        "reranked": 0,
+        "duplicates_removed": 0,
+        "unranked_pages": 0,
+        "stopped_early": False,
+    }
+    # One backend for the whole run: scores from different backends (or
+    # retrieval scores) aren't on the same scale
+    backend = reranker.pin()
+    stats["backend"] = backend.label()
+
+    def fetch(size: int, cursor: Optional[List[Any]], pit: Optional[str]):
+        return asyncio.ensure_future(
+            anyio.to_thread.run_sync(fetch_page, os_client, query, size, cursor, pit)
+        )
+
+    pit_id = await anyio.to_thread.run_sync(open_pit, os_client)
+    top: List[Dict[str, Any]] = []
+    seen: set = set()
+    stale = 0
+    pending: Optional[asyncio.Future] = fetch(page_size, None, pit_id)
+    try:
+        while pending is not None:
+            page, cursor = await pending
+            pending = None
+            stats["pages"] += 1
+            stats["fetched"] += len(page)
+
+            # Kick off the next page before spending time on this one
+            remaining = max_candidates - stats["fetched"]
+            if cursor and remaining > 0:
+                pending = fetch(min(page_size, remaining), cursor, pit_id)
+
+            fresh: List[Dict[str, Any]] = []
+            for d in page:
+                keys = {("id", str(d.get("id")))}
+                if d.get("pmid"):
+                    keys.add(("pmid", str(d["pmid"])))
+                if keys & seen:
+                    stats["duplicates_removed"] += 1
+                    continue
+                seen |= keys
+                fresh.append(d)
+            if DEDUP_ENABLED:
+                fresh, removed = await anyio.to_thread.run_sync(
+                    collapse_duplicates, fresh
+                )
+                stats["duplicates_removed"] += removed
+
+            improved = False
+            if fresh:
+                ranked = await backend.rerank(
+                    http, query, fresh, top_k, fallback=False
+                )
+                stats["reranked"] += len(fresh)
+                if not ranked:
+                    # No valid ranking: retrieval scores can't be merged
+                    stats["unranked_pages"] += 1
+                new_top = _merge_top(top, ranked, top_k)
+                improved = [d.get("id") for d in new_top] != [d.get("id") for d in top]
+                top = new_top
+
+            stale = 0 if improved else stale + 1
+            if pending is not None and stale >= patience:
+                stats["stopped_early"] = True
+                break
+    finally:
+        if pending is not None:
+            pending.cancel()
+        await anyio.to_thread.run_sync(close_pit, os_client, pit_id)
+
+    return top, stats
@@ -0,0 +1,530 @@
+# app/ingest.py
+"""
+Bulk ingestion that normalizes documents at index time.
+
+Every indexed document gets structured fields, picked with the same logic
+os_search uses at query time:
+  {"PMID": str, "title": str | null, "abstract": str, ...}
+A JSON `message` blob is lifted into top-level fields and dropped, so
+queries can skip the message/"*" fields (OPENSEARCH_NORMALIZED=true) and
+hits no longer need a json.loads each. A plain-text `message` that isn't
+the abstract moves to `message_text`. Every other _source field (s3, ...)
+is kept as is.
+
+    # local JSONL (.jsonl / .jsonl.gz / .json files, or a directory of them)
+    python -m app.ingest load export.jsonl --index pubmed-abstracts
+    # S3-style source (S3_ENDPOINT_URL works for MinIO/LocalStack)
+    python -m app.ingest load s3://bucket/pubmed/ --index pubmed-abstracts
+    # rewrite the messy documents already in the index, in place
+    python -m app.ingest reindex --index pubmed-abstracts
+    # or copy everything, normalized and keyed by PMID, into a new index
+    python -m app.ingest reindex --index pubmed-abstracts --dest pubmed-v2
+
+`load` and `--dest` key documents by PMID, so the index deduplicates them
+(a later copy replaces an earlier one). An in-place reindex keeps each
+document's _id and deletes messy copies of a PMID that was already written
+or that a clean document holds; rewritten documents no longer match the
+messy filter, so a second run only sees what it couldn't fix. Actions go
+out as size-bounded `_bulk` requests by a small thread pool. Reading the source
+pauses while INGEST_WORKERS requests are in flight (backpressure);
+429/5xx responses and connection errors are retried with exponential
+backoff, only for the items that failed. `--endpoint http://localhost:9200`
+talks to an unsigned local OpenSearch for throughput runs; `--dry-run`
+measures reading + normalizing alone.
+"""
+import os
+import io
+import sys
+import gzip
+import time
+import random
+import argparse
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from functools import partial
+from typing import (
+    List,
+    Dict,
+    Any,
+    Optional,
+    Iterable,
+    Iterator,
+    Set,
+    Tuple,
+    Callable,
+)
+
+from opensearchpy import OpenSearch  # type: ignore
+from opensearchpy.exceptions import TransportError  # type: ignore
+
+from .retrieval import (
+    OPENSEARCH_INDEX,
+    _parse_message_json,
+    _pick_text,
+    _pick_title,
+    _pick_pmid,
+)
+from .serialization import FastJSONSerializer, dumps, loads
+
+# -----------------------
+# Environment / Defaults
+# -----------------------
+INGEST_BATCH_DOCS = int(os.getenv("INGEST_BATCH_DOCS", "1000"))
+INGEST_BATCH_BYTES = int(os.getenv("INGEST_BATCH_BYTES", str(5 * 1024 * 1024)))
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "4"))  # concurrent _bulk requests
+INGEST_MAX_RETRIES = int(os.getenv("INGEST_MAX_RETRIES", "5"))
+INGEST_BACKOFF_S = float(os.getenv("INGEST_BACKOFF_S", "0.5"))  # doubles per retry
+INGEST_SCAN_SIZE = int(os.getenv("INGEST_SCAN_SIZE", "1000"))  # reindex page size
+INGEST_SCROLL = os.getenv("INGEST_SCROLL", "5m")
+
+_RETRY_STATUSES = frozenset({429, 502, 503, 504})
+# `message` JSON keys the _pick_* helpers already turn into structured fields
+_PICKED_KEYS = frozenset({"abstract", "text", "title", "PMID", "pmid"})
+# Where a plain-text `message` goes: left as `message`, it would keep the
+# document in MESSY_QUERY and get it rewritten on every reindex
+_MESSAGE_TEXT_FIELD = "message_text"
+_MAX_BACKOFF_S = 30.0
+
+# Documents the query path still has to dig out of `message`
+MESSY_QUERY = {
+    "bool": {
+        "should": [
+            {"bool": {"must_not": {"exists": {"field": "abstract"}}}},
+            {"bool": {"must_not": {"exists": {"field": "PMID"}}}},
+            {"exists": {"field": "message"}},
+        ],
+        "minimum_should_match": 1,
+    }
+}
+
+INDEX_MAPPINGS = {
+    "properties": {
+        "PMID": {"type": "keyword"},
+        "title": {"type": "text"},
+        "abstract": {"type": "text"},
+        "s3": {"type": "object", "enabled": False},
+    }
+}
+
+
+# -----------------------
+# Sources
+# -----------------------
+def _iter_file_lines(path: str) -> Iterator[bytes]:
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        yield from f
+
+
+def _iter_s3_lines(uri: str) -> Iterator[Tuple[str, bytes]]:
+    import boto3
+
+    bucket, _, prefix = uri[len("s3://") :].partition("/")
+    s3 = boto3.client("s3", endpoint_url=os.getenv("S3_ENDPOINT_URL") or None)
+    for page in s3.get_paginator("list_objects_v2").paginate(
+        Bucket=bucket, Prefix=prefix
+    ):
+        for obj in page.get("Contents", []):
+            key = obj["Key"]
+            body = s3.get_object(Bucket=bucket, Key=key)["Body"]
+            if key.endswith(".gz"):
+                for line in io.BufferedReader(gzip.GzipFile(fileobj=body)):
+                    yield key, line
+            elif key.endswith(".json"):
+                yield key, body.read()
+            else:
+                for line in body.iter_lines(chunk_size=1 << 20):
+                    yield key, line
+
+
+def _iter_local_lines(path: str) -> Iterator[Tuple[str, bytes]]:
+    if os.path.isdir(path):
+        names = sorted(
+            n for n in os.listdir(path) if n.endswith((".jsonl", ".jsonl.gz", ".json"))
+        )
+        for name in names:
+            yield from _iter_local_lines(os.path.join(path, name))
+    elif path.endswith(".json"):
+        with open(path, "rb") as f:
+            yield path, f.read()
+    else:
+        for line in _iter_file_lines(path):
+            yield path, line
+
+
+def iter_source(uri: str) -> Iterator[Dict[str, Any]]:
+    """
+    Stream raw documents from a local file/directory or s3://bucket/prefix.
+    JSONL lines (optionally gzipped) are one document each; a .json object
+    is a document, or a list of them. Unparseable lines are skipped.
+    """
+    lines = _iter_s3_lines(uri) if uri.startswith("s3://") else _iter_local_lines(uri)
+    for _, line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = loads(line)
+        except ValueError:
+            continue
+        for item in row if isinstance(row, list) else [row]:
+            if isinstance(item, dict):
+                yield item
+
+
+def normalize(row: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Structured document for a raw row (a bare _source or an OpenSearch hit):
+    the original fields, the other keys of a JSON `message` (without
+    overriding top-level ones) and PMID/title/abstract. A plain-text
+    `message` that didn't become the abstract is kept as `message_text`.
+    None when there is no usable text.
+    """
+    src = row["_source"] if isinstance(row.get("_source"), dict) else row
+    text = _pick_text(src)
+    if not text:
+        return None
+    # "_"-prefixed keys are hit metadata (_id, _score, ...) in bare exports
+    doc: Dict[str, Any] = {
+        k: v for k, v in src.items() if k != "message" and not k.startswith("_")
+    }
+    msg = src.get("message")
+    parsed = _parse_message_json(msg)
+    for key, value in parsed.items():
+        if key not in _PICKED_KEYS:
+            doc.setdefault(key, value)
+    if isinstance(msg, str) and not parsed and msg.strip() != text:
+        doc.setdefault(_MESSAGE_TEXT_FIELD, msg)
+    doc["PMID"] = _pick_pmid(src)
+    doc["title"] = _pick_title(src)
+    doc["abstract"] = text
+    return doc
+
+
+# -----------------------
+# Actions + batching
+# -----------------------
+def iter_actions(
+    rows: Iterable[Dict[str, Any]],
+    index: str,
+    stats: Dict[str, int],
+    keep_ids: bool = False,
+    claimed: Optional[Callable[[List[str]], Set[str]]] = None,
+) -> Iterator[bytes]:
+    """
+    NDJSON `_bulk` actions for normalized documents.
+
+    By default documents are keyed by PMID, which deduplicates them. With
+    keep_ids (in-place reindex) each hit keeps its own _id and is deleted
+    instead when its PMID was already written in this run or is one of
+    `claimed(pmids)` (held by other documents in the index). Hits that
+    normalize() wouldn't change are skipped.
+    """
+    if not keep_ids:
+        for row in rows:
+            stats["read"] += 1
+            doc = normalize(row)
+            if doc is None or doc["PMID"] is None:
+                stats["skipped"] += 1
+                continue
+            meta = dumps({"index": {"_index": index, "_id": doc["PMID"]}})
+            yield meta + b"\n" + dumps(doc) + b"\n"
+        return
+
+    seen: Set[str] = set()
+    rows = iter(rows)
+    while True:
+        chunk = [(row, normalize(row)) for row in islice(rows, INGEST_SCAN_SIZE)]
+        if not chunk:
+            return
+        pmids = {d["PMID"] for _, d in chunk if d is not None and d["PMID"]} - seen
+        taken = claimed(sorted(pmids)) if claimed and pmids else set()
+        for row, doc in chunk:
+            stats["read"] += 1
+            if doc is None:
+                stats["skipped"] += 1
+                continue
+            pmid = doc["PMID"]
+            if pmid is not None and (pmid in seen or pmid in taken):
+                stats["duplicates"] += 1
+                yield dumps({"delete": {"_index": index, "_id": row["_id"]}}) + b"\n"
+                continue
+            if pmid is not None:
+                seen.add(pmid)
+            else:
+                del doc["PMID"]
+            if doc == row.get("_source"):
+                stats["skipped"] += 1  # nothing to fix (e.g. no PMID anywhere)
+                continue
+            meta = dumps({"index": {"_index": index, "_id": row["_id"]}})
+            yield meta + b"\n" + dumps(doc) + b"\n"
+
+
+def iter_batches(
+    actions: Iterable[bytes],
+    max_docs: int = INGEST_BATCH_DOCS,
+    max_bytes: int = INGEST_BATCH_BYTES,
+) -> Iterator[List[bytes]]:
+    """Group actions into batches capped by count and request size."""
+    batch: List[bytes] = []
+    size = 0
+    for action in actions:
+        if batch and (len(batch) >= max_docs or size + len(action) > max_bytes):
+            yield batch
+            batch, size = [], 0
+        batch.append(action)
+        size += len(action)
+    if batch:
+        yield batch
+
+
+# -----------------------
+# Sending
+# -----------------------
+def _backoff(attempt: int) -> None:
+    delay = min(_MAX_BACKOFF_S, INGEST_BACKOFF_S * (2**attempt))
+    time.sleep(delay * random.uniform(0.5, 1.0))
+
+
+def send_batch(
+    os_client: OpenSearch, batch: List[bytes], max_retries: int = INGEST_MAX_RETRIES
+) -> Dict[str, int]:
+    """
+    POST one `_bulk` request, retrying throttled/unavailable responses and
+    the individual items rejected with a retryable status.
+    """
+    out = {"indexed": 0, "deleted": 0, "failed": 0, "retries": 0}
+    pending = batch
+    for attempt in range(max_retries + 1):
+        if attempt:
+            out["retries"] += 1
+            _backoff(attempt - 1)
+        try:
+            res = os_client.bulk(
+                body=b"".join(pending),
+                filter_path="errors,items.*.status,items.*.error.type",
+            )
+        except TransportError as e:
+            # ConnectionError/ConnectionTimeout carry a non-int status_code
+            status = getattr(e, "status_code", None)
+            if isinstance(status, int) and status not in _RETRY_STATUSES:
+                raise
+            continue
+
+        retry: List[bytes] = []
+        for action, item in zip(pending, res.get("items", [])):
+            op, result = next(iter(item.items()))
+            status = result.get("status", 500)
+            if status < 300 or (op == "delete" and status == 404):
+                out["deleted" if op == "delete" else "indexed"] += 1
+            elif status in _RETRY_STATUSES:
+                retry.append(action)
+            else:
+                out["failed"] += 1
+        if not retry:
+            return out
+        pending = retry
+    out["failed"] += len(pending)
+    return out
+
+
+def bulk_ingest(
+    os_client: Optional[OpenSearch],
+    actions: Iterable[bytes],
+    stats: Dict[str, int],
+    workers: int = INGEST_WORKERS,
+) -> Dict[str, int]:
+    """
+    Send batches with at most `workers` requests in flight; the action
+    iterator (and so the source) is only advanced when a slot frees up.
+    With os_client=None nothing is sent (dry run).
+    """
+    workers = max(1, workers)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        inflight: Set[Future] = set()
+
+        def collect(done: Iterable[Future]) -> None:
+            for fut in done:
+                for key, n in fut.result().items():
+                    stats[key] += n
+
+        for batch in iter_batches(actions):
+            stats["batches"] += 1
+            stats["bytes"] += sum(len(a) for a in batch)
+            if os_client is None:
+                stats["indexed"] += len(batch)
+                continue
+            if len(inflight) >= workers:
+                done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+                collect(done)
+            inflight.add(pool.submit(send_batch, os_client, batch))
+        collect(wait(inflight).done)
+    return stats
+
+
+# -----------------------
+# Index helpers
+# -----------------------
+def ensure_index(os_client: OpenSearch, index: str) -> None:
+    """Create `index` with the normalized mapping if it doesn't exist yet."""
+    if not os_client.indices.exists(index=index):
+        os_client.indices.create(index=index, body={"mappings": INDEX_MAPPINGS})
+
+
+@contextmanager
+def paused_refresh(os_client: Optional[OpenSearch], index: str) -> Iterator[None]:
+    """Turn off periodic refresh during the load, restore it (and refresh) after."""
+    if os_client is None:
+        yield
+        return
+    settings = os_client.indices.get_settings(index=index, name="index.refresh_interval")
+    prev = next(iter(settings.values()), {}).get("settings", {})
+    prev = prev.get("index", {}).get("refresh_interval")  # None = cluster default
+    os_client.indices.put_settings(
+        index=index, body={"index": {"refresh_interval": "-1"}}
+    )
+    try:
+        yield
+    finally:
+        os_client.indices.put_settings(
+            index=index, body={"index": {"refresh_interval": prev}}
+        )
+        os_client.indices.refresh(index=index)
+
+
+def scan_index(
+    os_client: OpenSearch, index: str, query: Optional[Dict[str, Any]] = None
+) -> Iterator[Dict[str, Any]]:
+    """Every hit matching `query` (default: all), via a scroll snapshot."""
+    from opensearchpy.helpers import scan  # type: ignore
+
+    yield from scan(
+        os_client,
+        index=index,
+        query={"query": query or {"match_all": {}}},
+        size=INGEST_SCAN_SIZE,
+        scroll=INGEST_SCROLL,
+    )
+
+
+def clean_pmids(os_client: OpenSearch, index: str, pmids: List[str]) -> Set[str]:
+    """The PMIDs in `pmids` already held by a normalized (non-messy) document."""
+    res = os_client.search(
+        index=index,
+        body={
+            "size": 10000,  # index.max_result_window default
+            "_source": ["PMID"],
+            "query": {
+                "bool": {
+                    "filter": {"terms": {"PMID": pmids}},
+                    "must_not": MESSY_QUERY,
+                }
+            },
+        },
+    )
+    return {str(h["_source"]["PMID"]) for h in res["hits"]["hits"]}
+
+
+def _local_client(endpoint: str) -> OpenSearch:
+    """Unsigned client for a local stand-in (e.g. the opensearch Docker image)."""
+    return OpenSearch(
+        hosts=[endpoint],
+        timeout=60,
+        max_retries=0,  # send_batch does its own retrying
+        verify_certs=False,
+        ssl_show_warn=False,
+        serializer=FastJSONSerializer(),
+    )
+
+
+def _new_stats() -> Dict[str, int]:
+    keys = (
+        "read",
+        "skipped",
+        "duplicates",
+        "batches",
+        "bytes",
+        "indexed",
+        "deleted",
+        "failed",
+        "retries",
+    )
+    return {k: 0 for k in keys}
+
+
+def _report(stats: Dict[str, int], seconds: float) -> None:
+    rate = stats["indexed"] / seconds if seconds else 0.0
+    mb_rate = stats["bytes"] / seconds / 1e6 if seconds else 0.0
+    print(
+        f"indexed {stats['indexed']} docs in {seconds:.1f}s "
+        f"({rate:.0f} docs/s, {mb_rate:.1f} MB/s, {stats['batches']} batches)"
+    )
+    print(
+        f"read={stats['read']} skipped={stats['skipped']} "
+        f"duplicates={stats['duplicates']} deleted={stats['deleted']} "
+        f"failed={stats['failed']} retries={stats['retries']}"
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m app.ingest")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_load = sub.add_parser("load", help="index documents from JSONL or S3")
+    p_load.add_argument("source", help="file, directory or s3://bucket/prefix")
+    p_reindex = sub.add_parser("reindex", help="normalize documents already indexed")
+    p_reindex.add_argument(
+        "--dest", help="copy into this index (keyed by PMID) instead of in place"
+    )
+    for p in (p_load, p_reindex):
+        p.add_argument("--index", default=OPENSEARCH_INDEX)
+        p.add_argument(
+            "--endpoint", help="unsigned local OpenSearch URL, e.g. http://localhost:9200"
+        )
+        p.add_argument("--workers", type=int, default=INGEST_WORKERS)
+        p.add_argument(
+            "--pause-refresh",
+            action="store_true",
+            help="disable refresh_interval while loading",
+        )
+    p_load.add_argument(
+        "--dry-run", action="store_true", help="read + normalize only, send nothing"
+    )
+
+    args = parser.parse_args(argv)
+    dry_run = getattr(args, "dry_run", False)
+    if dry_run:
+        os_client = None
+    elif args.endpoint:
+        os_client = _local_client(args.endpoint)
+    else:
+        from .clients import get_os_client
+
+        os_client = get_os_client()
+
+    stats = _new_stats()
+    if args.cmd == "load":
+        target = args.index
+        actions = iter_actions(iter_source(args.source), target, stats)
+    elif args.dest:
+        if args.dest == args.index:
+            sys.exit("--dest must differ from --index (omit it to rewrite in place)")
+        target = args.dest
+        actions = iter_actions(scan_index(os_client, args.index), target, stats)
+    else:
+        target = args.index
+        rows = scan_index(os_client, args.index, MESSY_QUERY)
+        claimed = partial(clean_pmids, os_client, target)
+        actions = iter_actions(rows, target, stats, keep_ids=True, claimed=claimed)
+
+    if os_client is not None:
+        ensure_index(os_client, target)
+    t0 = time.perf_counter()
+    with paused_refresh(os_client if args.pause_refresh else None, target):
+        bulk_ingest(os_client, actions, stats, args.workers)
+    _report(stats, time.perf_counter() - t0)
+
+
+if __name__ == "__main__":
+    main()
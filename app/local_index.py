@@ -0,0 +1,406 @@
+# app/local_index.py
+"""
+Embedded BM25 index for the hot set of PubMed abstracts.
+
+Layout of an index directory (all integers are native-endian):
+  meta.json      corpus stats + BM25 params
+  lexicon.json   term -> [postings offset, document frequency]
+  postings.bin   uint32 (doc, tf) pairs, grouped by term
+  doclens.bin    uint32 token count per doc
+  docs.bin       UTF-8 JSON record per doc (id, pmid, title, text, s3)
+  docs.off       uint64 byte offsets into docs.bin (n_docs + 1 entries)
+
+The .bin/.off files are memory-mapped, so opening an index is cheap and
+the page cache is shared between workers serving the same directory.
+"""
+import os
+import re
+import json
+import math
+import mmap
+import heapq
+import shutil
+import argparse
+import statistics
+import threading
+import time
+from array import array
+from collections import Counter, defaultdict
+from operator import itemgetter
+from typing import List, Dict, Any, Optional, Iterable, Iterator, Tuple
+
+from .retrieval import _hit_to_candidate, _pick_pmid, hybrid_search, local_is_strong
+
+# -----------------------
+# Environment / Defaults
+# -----------------------
+BM25_K1 = float(os.getenv("LOCAL_INDEX_K1", "1.2"))
+BM25_B = float(os.getenv("LOCAL_INDEX_B", "0.75"))
+# How often a running process checks whether `build` swapped in a new index
+LOCAL_INDEX_RELOAD_S = float(os.getenv("LOCAL_INDEX_RELOAD_S", "30"))
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from in into is it of on or that the this "
+    "to was were which with".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased alphanumeric tokens, minus a small English stoplist."""
+    return [t for t in _TOKEN_RE.findall((text or "").lower()) if t not in _STOPWORDS]
+
+
+def _map(path: str) -> Optional[mmap.mmap]:
+    # mmap refuses zero-length files (an index built from an empty export)
+    if os.path.getsize(path) == 0:
+        return None
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+# -----------------------
+# Reader
+# -----------------------
+class LocalIndex:
+    """Read-only, memory-mapped BM25 index. Use LocalIndex.open(path)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            self.meta: Dict[str, Any] = json.load(f)
+        with open(os.path.join(path, "lexicon.json"), encoding="utf-8") as f:
+            self._lexicon: Dict[str, List[int]] = json.load(f)
+
+        self._maps = [
+            _map(os.path.join(path, name))
+            for name in ("postings.bin", "doclens.bin", "docs.bin", "docs.off")
+        ]
+        postings, doclens, docs, offsets = self._maps
+        self._postings = memoryview(postings).cast("I") if postings else []
+        self._doclens = memoryview(doclens).cast("I") if doclens else []
+        self._docs = docs
+        self._offsets = memoryview(offsets).cast("Q") if offsets else []
+
+        self.n_docs: int = self.meta["n_docs"]
+        self._avgdl: float = self.meta["avgdl"] or 1.0
+        self._k1: float = self.meta["k1"]
+        self._b: float = self.meta["b"]
+
+    @classmethod
+    def open(cls, path: str) -> "LocalIndex":
+        return cls(path)
+
+    def close(self) -> None:
+        # Release the views before the maps, otherwise mmap.close() raises BufferError
+        for view in (self._postings, self._doclens, self._offsets):
+            if isinstance(view, memoryview):
+                view.release()
+        for m in self._maps:
+            if m is not None:
+                m.close()
+
+    def __len__(self) -> int:
+        return self.n_docs
+
+    def doc(self, doc_no: int) -> Dict[str, Any]:
+        start, end = self._offsets[doc_no], self._offsets[doc_no + 1]
+        return json.loads(self._docs[start:end])
+
+    def iter_docs(self) -> Iterator[Dict[str, Any]]:
+        for i in range(self.n_docs):
+            yield self.doc(i)
+
+    def search(self, query: str, k: int) -> List[Dict[str, Any]]:
+        """
+        BM25 over title + abstract. Returns up to k candidates in the same
+        shape as os_search (id, score, pmid, title, text, s3).
+        """
+        return self.search_with_coverage(query, k)[0]
+
+    def search_with_coverage(
+        self, query: str, k: int
+    ) -> Tuple[List[Dict[str, Any]], List[float]]:
+        """
+        search() plus, per hit, the fraction of the query's terms it
+        contains (how well the hot set covers the query, unlike raw BM25).
+        """
+        terms = set(tokenize(query))
+        if not self.n_docs or not terms:
+            return [], []
+
+        n, k1, b, avgdl = self.n_docs, self._k1, self._b, self._avgdl
+        postings, doclens = self._postings, self._doclens
+        scores: Dict[int, float] = defaultdict(float)
+        matched: Dict[int, int] = defaultdict(int)
+
+        for term in terms:
+            entry = self._lexicon.get(term)
+            if not entry:
+                continue
+            off, df = entry
+            idf = math.log(1.0 + (n - df + 0.5) / (df + 0.5))
+            for i in range(2 * off, 2 * (off + df), 2):
+                doc_no, tf = postings[i], postings[i + 1]
+                norm = k1 * (1.0 - b + b * doclens[doc_no] / avgdl)
+                scores[doc_no] += idf * tf * (k1 + 1.0) / (tf + norm)
+                matched[doc_no] += 1
+
+        top = heapq.nlargest(k, scores.items(), key=itemgetter(1))
+        hits = [{**self.doc(doc_no), "score": score} for doc_no, score in top]
+        return hits, [matched[doc_no] / len(terms) for doc_no, _ in top]
+
+
+class ReloadingIndex:
+    """
+    A LocalIndex that reopens itself once `build` swaps in a new one
+    (meta.json's built_at changes), checked at most every check_every
+    seconds. The replaced index isn't closed: searches still running on it
+    keep their maps, which are released when it is garbage-collected.
+    """
+
+    def __init__(self, path: str, check_every: float = LOCAL_INDEX_RELOAD_S):
+        self.path = path
+        self.check_every = check_every
+        self._index = LocalIndex.open(path)
+        self._checked_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _current(self) -> LocalIndex:
+        now = time.monotonic()
+        if now - self._checked_at < self.check_every or not self._lock.acquire(
+            blocking=False
+        ):
+            return self._index
+        try:
+            self._checked_at = now
+            with open(os.path.join(self.path, "meta.json"), encoding="utf-8") as f:
+                built_at = json.load(f).get("built_at")
+            if built_at != self._index.meta.get("built_at"):
+                self._index = LocalIndex.open(self.path)
+        except (OSError, ValueError):
+            pass  # mid-swap; keep serving the current one and retry later
+        finally:
+            self._lock.release()
+        return self._index
+
+    @property
+    def meta(self) -> Dict[str, Any]:
+        return self._current().meta
+
+    def __len__(self) -> int:
+        return len(self._current())
+
+    def search(self, query: str, k: int) -> List[Dict[str, Any]]:
+        return self._current().search(query, k)
+
+    def search_with_coverage(
+        self, query: str, k: int
+    ) -> Tuple[List[Dict[str, Any]], List[float]]:
+        return self._current().search_with_coverage(query, k)
+
+    def close(self) -> None:
+        self._index.close()
+
+
+# -----------------------
+# Builder
+# -----------------------
+def iter_export(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Read an index export (JSONL). Each line is either a raw OpenSearch hit
+    ({"_id": ..., "_source": {...}}) or a bare _source document.
+    Decoded with the same field-picking logic as os_search.
+    """
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(row, dict):
+                continue
+            if "_source" not in row:
+                row = {"_id": _pick_pmid(row), "_source": row}
+            cand = _hit_to_candidate(row)
+            if cand is not None and cand.get("id") is not None:
+                yield cand
+
+
+def _write_index(path: str, docs: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    os.makedirs(path, exist_ok=True)
+    inverted: Dict[str, List[int]] = defaultdict(list)
+    doclens = array("I")
+    offsets = array("Q", [0])
+
+    with open(os.path.join(path, "docs.bin"), "wb") as docs_f:
+        pos = 0
+        for doc_no, d in enumerate(docs):
+            record = {key: d.get(key) for key in ("id", "pmid", "title", "text", "s3")}
+            blob = json.dumps(record, ensure_ascii=False).encode("utf-8")
+            docs_f.write(blob)
+            pos += len(blob)
+            offsets.append(pos)
+
+            tokens = tokenize(f"{d.get('title') or ''} {d.get('text') or ''}")
+            doclens.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                inverted[term].extend((doc_no, tf))
+
+    lexicon: Dict[str, List[int]] = {}
+    postings = array("I")
+    for term in sorted(inverted):
+        pairs = inverted[term]
+        lexicon[term] = [len(postings) // 2, len(pairs) // 2]
+        postings.extend(pairs)
+
+    with open(os.path.join(path, "postings.bin"), "wb") as f:
+        postings.tofile(f)
+    with open(os.path.join(path, "doclens.bin"), "wb") as f:
+        doclens.tofile(f)
+    with open(os.path.join(path, "docs.off"), "wb") as f:
+        offsets.tofile(f)
+    with open(os.path.join(path, "lexicon.json"), "w", encoding="utf-8") as f:
+        json.dump(lexicon, f, ensure_ascii=False, separators=(",", ":"))
+
+    n_docs = len(doclens)
+    meta = {
+        "version": 1,
+        "n_docs": n_docs,
+        "n_terms": len(lexicon),
+        "avgdl": (sum(doclens) / n_docs) if n_docs else 0.0,
+        "k1": BM25_K1,
+        "b": BM25_B,
+        "built_at": time.time(),  # sub-second: ReloadingIndex compares it
+    }
+    with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    return meta
+
+
+def build_index(
+    path: str, docs: Iterable[Dict[str, Any]], incremental: bool = False
+) -> Dict[str, Any]:
+    """
+    Build (or rebuild) the index at `path` from candidate-shaped docs.
+
+    With incremental=True, docs already in the index are kept and the new
+    ones are upserted by id, so a partial export refreshes the hot set
+    without re-exporting it all. The new index is written next to the old
+    one and swapped in, so readers never see a half-written directory.
+    """
+    merged: Dict[str, Dict[str, Any]] = {}
+    if incremental and os.path.exists(os.path.join(path, "meta.json")):
+        old = LocalIndex.open(path)
+        try:
+            for d in old.iter_docs():
+                merged[str(d["id"])] = d
+        finally:
+            old.close()
+    for d in docs:
+        merged[str(d["id"])] = d
+
+    tmp = f"{path.rstrip(os.sep)}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    meta = _write_index(tmp, merged.values())
+
+    stale = f"{path.rstrip(os.sep)}.old"
+    shutil.rmtree(stale, ignore_errors=True)
+    if os.path.exists(path):
+        os.replace(path, stale)
+    os.replace(tmp, path)
+    shutil.rmtree(stale, ignore_errors=True)
+    return meta
+
+
+# -----------------------
+# CLI: build / bench
+# -----------------------
+def _pct(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _bench(index_path: str, queries_path: str, k: int) -> None:
+    """
+    Compare local, hybrid and OpenSearch latency, and local/hybrid
+    recall@k (OpenSearch as ground truth).
+    """
+    from .clients import get_os_client
+    from .retrieval import os_search
+
+    os_client = get_os_client()
+    index = LocalIndex.open(index_path)
+    with open(queries_path, encoding="utf-8") as f:
+        queries = [q.strip() for q in f if q.strip()]
+
+    ms: Dict[str, List[float]] = {"local": [], "hybrid": [], "opensearch": []}
+    recalls: Dict[str, List[float]] = {"local": [], "hybrid": []}
+    answered_locally = 0
+    for q in queries:
+        t0 = time.perf_counter()
+        local, coverage = index.search_with_coverage(q, k)
+        t1 = time.perf_counter()
+        remote = os_search(os_client, q, k)
+        t2 = time.perf_counter()
+        hybrid = hybrid_search(os_client, index, q, k)
+        t3 = time.perf_counter()
+        ms["local"].append((t1 - t0) * 1000)
+        ms["opensearch"].append((t2 - t1) * 1000)
+        ms["hybrid"].append((t3 - t2) * 1000)
+        answered_locally += local_is_strong(local, coverage, k)
+
+        remote_ids = {str(d["id"]) for d in remote}
+        if remote_ids:
+            for name, got in (("local", local), ("hybrid", hybrid)):
+                hit = sum(1 for d in got if str(d["id"]) in remote_ids)
+                recalls[name].append(hit / len(remote_ids))
+    index.close()
+
+    print(f"queries={len(queries)} k={k} docs={len(index)}")
+    for name, values in ms.items():
+        print(
+            f"{name:>10}: p50={_pct(values, 0.5):.2f}ms p95={_pct(values, 0.95):.2f}ms "
+            f"mean={statistics.fmean(values) if values else 0:.2f}ms"
+        )
+    for name, values in recalls.items():
+        mean = statistics.fmean(values) if values else 0
+        print(f"{name} recall@{k} vs opensearch: {mean:.3f}")
+    print(f"answered from the hot set alone: {answered_locally}/{len(queries)}")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m app.local_index")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_build = sub.add_parser("build", help="build from an OpenSearch export (JSONL)")
+    p_build.add_argument("export")
+    p_build.add_argument("--index", default=os.getenv("LOCAL_INDEX_PATH", "local_index"))
+    p_build.add_argument(
+        "--incremental", action="store_true", help="upsert into the existing index"
+    )
+
+    p_bench = sub.add_parser("bench", help="latency/recall vs OpenSearch")
+    p_bench.add_argument("queries", help="text file, one query per line")
+    p_bench.add_argument("--index", default=os.getenv("LOCAL_INDEX_PATH", "local_index"))
+    p_bench.add_argument("-k", type=int, default=50)
+
+    args = parser.parse_args(argv)
+    if args.cmd == "build":
+        t0 = time.perf_counter()
+        meta = build_index(args.index, iter_export(args.export), args.incremental)
+        print(
+            f"indexed {meta['n_docs']} docs / {meta['n_terms']} terms "
+            f"into {args.index} in {time.perf_counter() - t0:.1f}s"
+        )
+    else:
+        _bench(args.index, args.queries, args.k)
+
+
+if __name__ == "__main__":
+    main()
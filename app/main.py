@@ -1,18 +1,80 @@
-from fastapi import FastAPI, HTTPException
+import hmac
+import hashlib
+from typing import Optional
+
+import anyio
+from fastapi import FastAPI, HTTPException, Request
 from .schemas import QueryRequest, QueryResponse
-from .clients import get_os_client, get_llm, get_http_client
-from .retrieval import os_search, call_reranker
-from .chain import build_chain, render_context
+from .serialization import FastJSONResponse
+from .clients import (
+    get_os_client,
+    get_llms,
+    get_http_client,
+    get_local_index,
+    get_reranker,
+)
+from .retrieval import hybrid_search
+from .dedup import search_deduped
+from .deep_retrieval import deep_retrieve_and_rerank
+from .admission import (
+    ADMISSION_API_KEYS,
+    Admission,
+    client_address,
+    PRIORITY_BATCH,
+    PRIORITY_INTERACTIVE,
+)
+from .chain import (
+    build_chain,
+    build_routed_chains,
+    choose_route,
+    render_context,
+)
 
 app = FastAPI()
 
 # singletons
 os_client = get_os_client()
-llm = get_llm()
-chain = build_chain(llm)
+local_index = get_local_index()
+reranker = get_reranker()
+llms = get_llms()
+chains = build_routed_chains(llms, build_chain)
+admission = Admission()
 http = None
 
 
+def _api_key(request: Request) -> Optional[str]:
+    """The X-API-Key if it's one of ADMISSION_API_KEYS, else None."""
+    api_key = request.headers.get("x-api-key")
+    if api_key and any(
+        hmac.compare_digest(api_key, known) for known in ADMISSION_API_KEYS
+    ):
+        return api_key
+    return None
+
+
+def _caller(request: Request) -> str:
+    """
+    Fair-queuing identity: a known API key, else the client address (from
+    X-Forwarded-For only behind ADMISSION_PROXY_HOPS proxies). Unknown keys
+    are ignored, so a fresh key per request doesn't buy a fresh queue.
+    """
+    api_key = _api_key(request)
+    if api_key:
+        return "key:" + hashlib.sha256(api_key.encode()).hexdigest()[:16]
+    peer = request.client.host if request.client else None
+    return "ip:" + client_address(request.headers.get("x-forwarded-for"), peer)
+
+
+def _priority(request: Request) -> int:
+    # /query is batch traffic; known API keys may mark themselves interactive
+    if (
+        request.headers.get("x-priority", "").lower() == "interactive"
+        and _api_key(request) is not None
+    ):
+        return PRIORITY_INTERACTIVE
+    return PRIORITY_BATCH
+
+
 @app.on_event("startup")
 async def _startup():
     global http
@@ -25,6 +87,7 @@ async def _shutdown():
     if http:
         await http.aclose()
         http = None
+    reranker.close()
 
 
 @app.get("/health")
@@ -32,30 +95,71 @@ def health():
     return {"ok": True}
 
 
-@app.post("/query", response_model=QueryResponse)
-async def query(req: QueryRequest):
-    # optional sanity caps
-    k = max(1, min(req.k or 50, 200))
+@app.get("/metrics/admission")
+def admission_metrics():
+    """Queue depth, active slots and wait-time stats per upstream."""
+    return admission.snapshot()
+
+
+@app.post(
+    "/query", response_model=QueryResponse, response_class=FastJSONResponse
+)
+async def query(req: QueryRequest, request: Request):
+    user, prio = _caller(request), _priority(request)
+
+    # optional sanity caps (deep_k lifts the 200 cap: it pages instead)
+    k = req.deep_k or max(1, min(req.k or 50, 200))
     top_k = max(1, min(req.top_k or 10, k))
 
-    raw = os_search(os_client, req.question, k)
-    if not raw:
-        return QueryResponse(answer="I couldn't find anything relevant.", sources=[])
+    if req.deep_k:
+        if http is None:
+            raise HTTPException(status_code=503, detail="HTTP client not ready")
+        try:
+            async with admission.slot("opensearch", user, prio):
+                async with admission.slot(reranker.admission_upstream, user, prio):
+                    reranked, _ = await deep_retrieve_and_rerank(
+                        os_client, reranker, http, req.question, top_k, k
+                    )
+        except RuntimeError as e:
+            raise HTTPException(status_code=502, detail=str(e))
+        if not reranked:
+            return {"answer": "I couldn't find anything relevant.", "sources": []}
+    else:
+        async with admission.slot("opensearch", user, prio):
+            raw, _, _ = await anyio.to_thread.run_sync(
+                search_deduped, hybrid_search, os_client, local_index, req.question, k
+            )
+        if not raw:
+            return {"answer": "I couldn't find anything relevant.", "sources": []}
+
+        if http is None:
+            raise HTTPException(status_code=503, detail="HTTP client not ready")
 
-    if http is None:
-        raise HTTPException(status_code=503, detail="HTTP client not ready")
+        try:
+            async with admission.slot(reranker.admission_upstream, user, prio):
+                reranked = await reranker.rerank(http, req.question, raw, top_k)
+        except RuntimeError as e:
+            raise HTTPException(status_code=502, detail=str(e))
 
-    reranked = await call_reranker(http, req.question, raw, top_k)
     context = render_context(reranked)
 
     try:
-        answer = chain.invoke({"question": req.question, "context": context})
+        chain = chains[choose_route(req.question, reranked, context)]
+        async with admission.slot("llm", user, prio):
+            # Stateless endpoint: the prompt's history slot is just empty
+            answer = await chain.ainvoke(
+                {"history": "", "question": req.question, "context": context}
+            )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=502, detail=f"Gemini (LangChain) error: {e}")
 
-    return QueryResponse(
-        answer=(answer or "").strip(),
-        sources=[
+    # Plain dict: response_model validates it once (returning a QueryResponse
+    # would be validated here and again on the way out)
+    return {
+        "answer": (answer or "").strip(),
+        "sources": [
             {
                 "id": d.get("id"),
                 "score": d.get("score"),
@@ -74,4 +178,4 @@ async def query(req: QueryRequest):
             }
             for d in reranked
         ],
-    )
+    }
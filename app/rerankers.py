@@ -0,0 +1,327 @@
+# app/rerankers.py
+"""
+Reranker backends. Every backend exposes the same coroutine:
+
+    await backend.rerank(http, query, passages, top_k) -> reranked passages
+
+and produces its ranking as {"indices": [...], "scores": [...]}, mapped back
+onto the passages by retrieval.apply_ranking, so callers can swap backends
+without caring which one answered. Scores are only comparable within one
+backend: callers that merge several calls (deep retrieval) take
+`backend.pin()` once and rerank with fallback=False.
+
+  HttpReranker     the GPU reranker service at RERANKER_URL
+  CpuReranker      in-process scoring on a ProcessPoolExecutor
+  RoutingReranker  GPU first, spilling to CPU when the GPU queue is deep or down
+
+`served_by` holds the label of the backend that answered the current task's
+last rerank, so callers can tell a spilled ranking from a GPU one.
+"""
+import os
+import asyncio
+import importlib
+import multiprocessing
+from contextvars import ContextVar
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import List, Dict, Any, Optional, Callable
+
+import httpx
+
+from .retrieval import call_reranker, apply_ranking
+from .local_index import tokenize
+
+# -----------------------
+# Environment / Defaults
+# -----------------------
+# No default: `cpu`/`router` need an explicit model (see clients.get_reranker)
+RERANKER_CPU_SCORER = os.getenv("RERANKER_CPU_SCORER", "")
+RERANKER_CPU_WORKERS = int(os.getenv("RERANKER_CPU_WORKERS", "0")) or None
+RERANKER_CPU_CHUNK = int(os.getenv("RERANKER_CPU_CHUNK", "32"))
+RERANKER_MAX_INFLIGHT = int(os.getenv("RERANKER_MAX_INFLIGHT", "4"))
+
+Scorer = Callable[[str, List[str]], List[float]]
+
+served_by: ContextVar[str] = ContextVar("reranker_served_by", default="")
+
+
+# -----------------------
+# Scoring models (run inside pool workers)
+# -----------------------
+def lexical_score(query: str, texts: List[str]) -> List[float]:
+    """
+    Query-term coverage with saturating tf, in [0, 1]. Depends only on the
+    (query, passage) pair, so scores are stable however passages are chunked
+    across workers. Meant for tests and as a last-resort CPU ranking.
+    """
+    q_terms = set(tokenize(query))
+    if not q_terms:
+        return [0.0] * len(texts)
+    out: List[float] = []
+    for text in texts:
+        counts: Dict[str, int] = {}
+        for t in tokenize(text):
+            if t in q_terms:
+                counts[t] = counts.get(t, 0) + 1
+        out.append(sum(tf / (tf + 1.2) for tf in counts.values()) / len(q_terms))
+    return out
+
+
+def _cross_encoder_scorer(model_name: str) -> Scorer:
+    try:
+        from sentence_transformers import CrossEncoder  # type: ignore
+    except Exception:
+        raise RuntimeError(
+            "cross-encoder scorer needs `sentence-transformers` installed"
+        )
+    model = CrossEncoder(model_name, device="cpu")
+
+    def score(query: str, texts: List[str]) -> List[float]:
+        return [float(s) for s in model.predict([(query, t) for t in texts])]
+
+    return score
+
+
+def load_scorer(spec: str) -> Scorer:
+    """
+    Resolve a scorer spec:
+      lexical                   lexical_score
+      cross-encoder:<model>     sentence-transformers CrossEncoder on CPU
+      <module>:<attr>           any importable callable(query, texts) -> scores
+    """
+    if spec == "lexical":
+        return lexical_score
+    if spec.startswith("cross-encoder:"):
+        return _cross_encoder_scorer(spec[len("cross-encoder:") :])
+    module, _, attr = spec.partition(":")
+    if not attr:
+        raise RuntimeError(f"Unknown reranker scorer spec: {spec!r}")
+    return getattr(importlib.import_module(module), attr)
+
+
+_worker_scorer: Optional[Scorer] = None
+
+
+def _init_worker(spec: str) -> None:
+    # Load the model once per worker process, not once per request
+    global _worker_scorer
+    _worker_scorer = load_scorer(spec)
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    try:
+        # 3.13+: don't let the worker's resource tracker unlink the parent's block
+        return shared_memory.SharedMemory(name=name, track=False)  # type: ignore[call-arg]
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+def _score_chunk(shm_name: str, offsets: List[int], query: str) -> List[float]:
+    """Worker entry: decode passages [offsets[i], offsets[i+1]) from shared memory and score them."""
+    shm = _attach(shm_name)
+    try:
+        buf = shm.buf
+        texts = [
+            bytes(buf[offsets[i] : offsets[i + 1]]).decode("utf-8")
+            for i in range(len(offsets) - 1)
+        ]
+        del buf
+    finally:
+        shm.close()
+    assert _worker_scorer is not None
+    return _worker_scorer(query, texts)
+
+
+def _top_k_ranking(scores: List[float], top_k: int) -> Dict[str, Any]:
+    order = sorted(range(len(scores)), key=lambda i: (-scores[i], i))[:top_k]
+    return {"indices": order, "scores": [scores[i] for i in order]}
+
+
+# -----------------------
+# Backends
+# -----------------------
+class RerankerBackend:
+    name = "base"
+    # Admission queue the callers put rerank calls behind (None: no queue)
+    admission_upstream: Optional[str] = "reranker"
+
+    async def rerank(
+        self,
+        http: Optional[httpx.AsyncClient],
+        query: str,
+        passages: List[Dict[str, Any]],
+        top_k: int,
+        fallback: bool = True,
+    ) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def label(self) -> str:
+        """Backend name plus model, as recorded in `served_by`."""
+        return self.name
+
+    def pin(self) -> "RerankerBackend":
+        """The backend to use for every call of a run whose scores get merged."""
+        return self
+
+    def close(self) -> None:
+        pass
+
+
+class HttpReranker(RerankerBackend):
+    """The remote GPU service (RERANKER_URL)."""
+
+    name = "http"
+
+    async def rerank(self, http, query, passages, top_k, fallback=True):
+        if http is None:
+            raise RuntimeError("HTTP reranker needs an httpx client")
+        out = await call_reranker(http, query, passages, top_k, fallback)
+        served_by.set(self.label())
+        return out
+
+
+class CpuReranker(RerankerBackend):
+    """
+    Scores (query, passage) pairs on a local process pool. Passage text is
+    written once into a shared-memory block; workers receive only the block
+    name and their slice offsets, so large batches aren't pickled per chunk.
+    """
+
+    name = "cpu"
+
+    def __init__(
+        self,
+        scorer: str = RERANKER_CPU_SCORER,
+        workers: Optional[int] = RERANKER_CPU_WORKERS,
+        chunk_size: int = RERANKER_CPU_CHUNK,
+    ):
+        self.scorer = scorer
+        self.workers = workers
+        self.chunk_size = max(1, chunk_size)
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        # Created lazily so importing the app doesn't start workers. By then
+        # the process runs gRPC and anyio threads, so never plain fork().
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("forkserver"),
+                initializer=_init_worker,
+                initargs=(self.scorer,),
+            )
+        return self._pool
+
+    async def rank(self, query: str, texts: List[str], top_k: int) -> Dict[str, Any]:
+        encoded = [t.encode("utf-8") for t in texts]
+        offsets = [0]
+        for b in encoded:
+            offsets.append(offsets[-1] + len(b))
+
+        shm = shared_memory.SharedMemory(create=True, size=max(1, offsets[-1]))
+        try:
+            shm.buf[: offsets[-1]] = b"".join(encoded)
+            loop = asyncio.get_running_loop()
+            pool = self._get_pool()
+            futures = [
+                loop.run_in_executor(
+                    pool,
+                    _score_chunk,
+                    shm.name,
+                    offsets[lo : lo + self.chunk_size + 1],
+                    query,
+                )
+                for lo in range(0, len(texts), self.chunk_size)
+            ]
+            chunks = await asyncio.gather(*futures)
+        finally:
+            shm.close()
+            shm.unlink()
+
+        scores = [float(s) for chunk in chunks for s in chunk]
+        return _top_k_ranking(scores, top_k)
+
+    async def rerank(self, http, query, passages, top_k, fallback=True):
+        if not passages:
+            return []
+        ranking = await self.rank(query, [p.get("text") or "" for p in passages], top_k)
+        served_by.set(self.label())
+        return apply_ranking(passages, ranking, top_k, fallback)
+
+    def label(self) -> str:
+        return f"cpu:{self.scorer}"
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+
+class RoutingReranker(RerankerBackend):
+    """
+    Sends work to `primary` (GPU) while fewer than `max_inflight` requests
+    are outstanding there; beyond that, or when the primary errors, the
+    request spills over to `spill` (CPU) instead of going unranked.
+    """
+
+    name = "router"
+    # Over max_inflight it spills to CPU; queueing in front would stop that
+    admission_upstream = None
+
+    def __init__(
+        self,
+        primary: RerankerBackend,
+        spill: RerankerBackend,
+        max_inflight: int = RERANKER_MAX_INFLIGHT,
+    ):
+        self.primary = primary
+        self.spill = spill
+        self.max_inflight = max(1, max_inflight)
+        self.inflight = 0
+        self.stats = {"primary": 0, "spilled": 0, "failed_over": 0}
+
+    async def _primary(self, http, query, passages, top_k, fallback=True):
+        self.inflight += 1
+        try:
+            out = await self.primary.rerank(http, query, passages, top_k, fallback)
+            self.stats["primary"] += 1
+            return out
+        finally:
+            self.inflight -= 1
+
+    async def rerank(self, http, query, passages, top_k, fallback=True):
+        if self.inflight >= self.max_inflight:
+            self.stats["spilled"] += 1
+            return await self.spill.rerank(http, query, passages, top_k, fallback)
+
+        try:
+            return await self._primary(http, query, passages, top_k, fallback)
+        except RuntimeError:
+            self.stats["failed_over"] += 1
+        return await self.spill.rerank(http, query, passages, top_k, fallback)
+
+    def pin(self) -> RerankerBackend:
+        """
+        Decide GPU vs CPU once for the whole run, so its scores stay on one
+        scale. No failover mid-run: a pinned primary's errors propagate.
+        """
+        if self.inflight >= self.max_inflight:
+            self.stats["spilled"] += 1
+            return self.spill
+        return _PinnedPrimary(self)
+
+    def close(self) -> None:
+        self.primary.close()
+        self.spill.close()
+
+
+class _PinnedPrimary(RerankerBackend):
+    """The router's primary, still counted in the router's inflight."""
+
+    def __init__(self, router: RoutingReranker):
+        self.router = router
+        self.name = router.primary.name
+
+    async def rerank(self, http, query, passages, top_k, fallback=True):
+        return await self.router._primary(http, query, passages, top_k, fallback)
+
@@ -1,6 +1,5 @@
 # retrieval.py
 import os
-import json
 from typing import List, Dict, Any, Optional
 
 import httpx
@@ -8,6 +7,8 @@ from fastapi import HTTPException
 
 from opensearchpy import OpenSearch, RequestsHttpConnection  # type: ignore
 
+from .serialization import FastJSONSerializer, loads, encode_body, decode_body
+
 try:
     # Available in opensearch-py >= 2.x for AWS-managed domains
     from opensearchpy.aws4auth import AWSV4SignerAuth  # type: ignore
@@ -26,7 +27,26 @@ OPENSEARCH_ENDPOINT = os.getenv("OPENSEARCH_ENDPOINT") or os.getenv("OS_ENDPOINT
 AWS_REGION = os.getenv("AWS_REGION") or os.getenv("AWS_DEFAULT_REGION") or "us-east-1"
 
 RERANKER_URL = os.getenv("RERANKER_URL", "http://10.0.101.235:9000/rerank")
+# Request body format: json | gzip | msgpack. Downgraded to json for the rest
+# of the process if the service rejects it.
+RERANKER_ENCODING = os.getenv("RERANKER_ENCODING", "json")
+_reranker_encoding = RERANKER_ENCODING
 RETRIEVE_K = int(os.getenv("RETRIEVE_K", "50"))  # how many docs to fetch pre-rerank
+# Set once every doc has structured PMID/title/abstract (python -m app.ingest):
+# queries then skip the `message` field and the "*" catch-all.
+OPENSEARCH_NORMALIZED = os.getenv("OPENSEARCH_NORMALIZED", "false").lower() == "true"
+
+# Local hot-set index (app/local_index.py): results count as "strong" when
+# there are enough of them, the best BM25 score clears the bar, and the top
+# hits contain most of the query's terms. Any shared term gets a BM25 score,
+# so hit count and score alone say little about how well the hot set covers
+# the query.
+LOCAL_INDEX_MIN_HITS = int(os.getenv("LOCAL_INDEX_MIN_HITS", "10"))
+LOCAL_INDEX_MIN_SCORE = float(os.getenv("LOCAL_INDEX_MIN_SCORE", "8.0"))
+LOCAL_INDEX_MIN_COVERAGE = float(os.getenv("LOCAL_INDEX_MIN_COVERAGE", "0.8"))
+# Slots of a merged result kept for local hits OpenSearch missed (the reranker
+# sees them even when OpenSearch fills all k)
+LOCAL_INDEX_MERGE_SLOTS = int(os.getenv("LOCAL_INDEX_MERGE_SLOTS", "10"))
 
 
 # -----------------------
@@ -59,6 +79,7 @@ def build_os_client() -> OpenSearch:
         timeout=30,
         max_retries=3,
         retry_on_timeout=True,
+        serializer=FastJSONSerializer(),
     )
 
 
@@ -73,7 +94,7 @@ def _parse_message_json(s: Optional[str]) -> Dict[str, Any]:
     if not s or s[0] not in ("{", "["):
         return {}
     try:
-        data = json.loads(s)
+        data = loads(s)
         if isinstance(data, dict):
             return data
         return {}
@@ -131,31 +152,64 @@ def _pick_pmid(src: Dict[str, Any]) -> Optional[str]:
     return None
 
 
+def _hit_to_candidate(h: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Decode one OpenSearch hit into the candidate shape used downstream.
+    Returns None for hits with no usable text.
+    """
+    src = h.get("_source") or {}
+    text = _pick_text(src)
+    if not text:
+        # Skip empty payloads
+        return None
+
+    return {
+        "id": h.get("_id"),  # OpenSearch doc _id (PMID in your sample)
+        "score": h.get("_score"),
+        "pmid": _pick_pmid(src),
+        "title": _pick_title(src),
+        "text": text,
+        # Handy to keep the S3 origin around for debugging/tracing
+        "s3": src.get("s3") or {},
+    }
+
+
 # -----------------------
 # Search + Rerank
 # -----------------------
-def os_search(
-    os_client: OpenSearch, query: str, k: int = RETRIEVE_K
-) -> List[Dict[str, Any]]:
-    """
-    Retrieve k candidates from OpenSearch, biased toward title/abstract,
-    but able to match 'message' or other fields if present.
-    """
-    body = {
-        "size": k,
+def search_body(query: str, size: int) -> Dict[str, Any]:
+    """The multi_match request body shared by os_search and deep retrieval."""
+    if OPENSEARCH_NORMALIZED:
+        fields = ["title^4", "abstract^3"]
+        source = ["PMID", "title", "abstract", "s3.*"]
+    else:
+        # Your mapping has: title(text), abstract(text), message(text)
+        # We weight title/abstract higher than message.
+        fields = ["title^4", "abstract^3", "message^1", "*"]
+        source = ["PMID", "title", "abstract", "message", "s3.*"]
+    return {
+        "size": size,
         "track_total_hits": False,
         "query": {
             "multi_match": {
                 "query": query,
-                # Your mapping has: title(text), abstract(text), message(text)
-                # We weight title/abstract higher than message.
-                "fields": ["title^4", "abstract^3", "message^1", "*"],
+                "fields": fields,
                 "type": "best_fields",
             }
         },
-        "_source": ["PMID", "title", "abstract", "message", "s3.*"],
+        "_source": source,
     }
 
+
+def os_search(
+    os_client: OpenSearch, query: str, k: int = RETRIEVE_K
+) -> List[Dict[str, Any]]:
+    """
+    Retrieve k candidates from OpenSearch, biased toward title/abstract,
+    but able to match 'message' or other fields if present.
+    """
+    body = search_body(query, k)
+
     try:
         res = os_client.search(index=OPENSEARCH_INDEX, body=body)
     except Exception as e:
@@ -164,28 +218,92 @@ def os_search(
     hits = res.get("hits", {}).get("hits", [])
     out: List[Dict[str, Any]] = []
     for h in hits:
-        src = h.get("_source") or {}
-        text = _pick_text(src)
-        if not text:
-            # Skip empty payloads
-            continue
-
-        out.append(
-            {
-                "id": h.get("_id"),  # OpenSearch doc _id (PMID in your sample)
-                "score": h.get("_score"),
-                "pmid": _pick_pmid(src),
-                "title": _pick_title(src),
-                "text": text,
-                # Handy to keep the S3 origin around for debugging/tracing
-                "s3": src.get("s3") or {},
-            }
-        )
+        cand = _hit_to_candidate(h)
+        if cand is not None:
+            out.append(cand)
     return out
 
 
+def local_is_strong(
+    local: List[Dict[str, Any]], coverage: List[float], k: int
+) -> bool:
+    """
+    Whether local hits can stand in for OpenSearch: enough of them, a top
+    score over LOCAL_INDEX_MIN_SCORE, and the first min(k, LOCAL_INDEX_MIN_HITS)
+    hits holding on average LOCAL_INDEX_MIN_COVERAGE of the query's terms.
+    """
+    need = min(k, LOCAL_INDEX_MIN_HITS)
+    if not local or len(local) < need or local[0]["score"] < LOCAL_INDEX_MIN_SCORE:
+        return False
+    head = coverage[: max(1, need)]
+    return sum(head) / len(head) >= LOCAL_INDEX_MIN_COVERAGE
+
+
+def hybrid_search(
+    os_client: OpenSearch, local_index: Any, query: str, k: int = RETRIEVE_K
+) -> List[Dict[str, Any]]:
+    """
+    Answer from the local hot-set index when its results are strong enough,
+    otherwise go to OpenSearch and merge in any local hits it missed.
+    `local_index` is an app.local_index.LocalIndex / ReloadingIndex (or None
+    to always go remote).
+    """
+    if local_index is None:
+        return os_search(os_client, query, k)
+
+    local, coverage = local_index.search_with_coverage(query, k)
+    if local_is_strong(local, coverage, k):
+        return local
+
+    try:
+        remote = os_search(os_client, query, k)
+    except HTTPException:
+        # Remote is down: whatever the hot set has beats an error page
+        if local:
+            return local
+        raise
+
+    seen = {str(d.get("id")) for d in remote}
+    extras = [d for d in local if str(d.get("id")) not in seen]
+    reserved = min(len(extras), LOCAL_INDEX_MERGE_SLOTS, k // 2)
+    # Unused reserved slots go back to OpenSearch
+    return remote[: k - reserved] + extras[: max(reserved, k - len(remote))]
+
+
+def apply_ranking(
+    passages: List[Dict[str, Any]],
+    ranking: Dict[str, Any],
+    top_k: int,
+    fallback: bool = True,
+) -> List[Dict[str, Any]]:
+    """
+    Map a reranker result ({"indices": [...], "scores": [...]}, indices into
+    `passages`) back onto the passages. Shared by every reranker backend so
+    their output shapes stay identical.
+    With fallback=False an empty ranking gives [] rather than the first
+    top_k passages with their (non-reranker) retrieval scores.
+    """
+    indices = ranking.get("indices") or []
+    scores = ranking.get("scores") or []
+
+    reranked: List[Dict[str, Any]] = []
+    for idx, score in zip(indices, scores):
+        if 0 <= idx < len(passages):
+            base = passages[idx]
+            reranked.append({**base, "score": score})
+
+    # Fallback if nothing valid came back
+    if not fallback:
+        return reranked[:top_k]
+    return reranked[:top_k] or passages[:top_k]
+
+
 async def call_reranker(
-    http: httpx.AsyncClient, query: str, passages: List[Dict[str, Any]], top_k: int
+    http: httpx.AsyncClient,
+    query: str,
+    passages: List[Dict[str, Any]],
+    top_k: int,
+    fallback: bool = True,
 ) -> List[Dict[str, Any]]:
     """
     Call the reranker service. Returns top_k passages with reranker scores.
@@ -199,26 +317,23 @@ async def call_reranker(
         "top_k": top_k,
     }
 
+    global _reranker_encoding
     try:
-        r = await http.post(RERANKER_URL, json=payload)
+        content, headers = encode_body(payload, _reranker_encoding)
+        r = await http.post(RERANKER_URL, content=content, headers=headers)
+        if r.status_code in (400, 415, 422) and _reranker_encoding != "json":
+            # Service doesn't speak this encoding: settle on plain JSON
+            _reranker_encoding = "json"
+            content, headers = encode_body(payload, _reranker_encoding)
+            r = await http.post(RERANKER_URL, content=content, headers=headers)
     except Exception as e:
         raise RuntimeError(f"Reranker request failed: {e}")
 
     if r.status_code != 200:
         raise RuntimeError(f"Reranker error {r.status_code}: {r.text}")
 
-    data = r.json()
-    indices = data.get("indices") or []
-    scores = data.get("scores") or []
-
-    reranked: List[Dict[str, Any]] = []
-    for idx, score in zip(indices, scores):
-        if 0 <= idx < len(passages):
-            base = passages[idx]
-            reranked.append({**base, "score": score})
-
-    # Fallback if nothing valid came back
-    return reranked or passages[:top_k]
+    data = decode_body(r.content, r.headers.get("content-type", ""))
+    return apply_ranking(passages, data, top_k, fallback)
 
 
 # Convenience orchestration (optional)
@@ -0,0 +1,155 @@
+# app/route_eval.py
+"""
+Offline comparison of routed answering vs always using the strong model.
+
+    python -m app.route_eval cases.jsonl          # fake LLMs with simulated latency
+    python -m app.route_eval cases.jsonl --live   # real Gemini models (GEMINI_API_KEY)
+
+cases.jsonl has one {"question": str, "docs": [candidate dicts]} per line
+(docs as returned by the reranker: title/text/pmid...).
+
+Reports time-to-first-token and total latency per config, the route mix,
+citation validity (every [n] refers to a real snippet) and, in live mode,
+token overlap between routed answers and the strong model's answers.
+"""
+import re
+import json
+import time
+import argparse
+import statistics
+from typing import List, Dict, Any, Iterator, Optional
+
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+from .chain import (
+    build_streaming_chain,
+    build_routed_chains,
+    choose_route,
+    render_context,
+)
+
+_CITE_RE = re.compile(r"\[(\d+)\]")
+
+
+class LatencyFakeChatModel(FakeListChatModel):
+    """FakeListChatModel that waits `ttft` seconds before the first chunk."""
+
+    ttft: float = 0.0
+
+    def _stream(self, *args: Any, **kwargs: Any) -> Iterator[Any]:
+        time.sleep(self.ttft)
+        yield from super()._stream(*args, **kwargs)
+
+
+def fake_llms(n_cases: int) -> Dict[str, Any]:
+    # Rough shape of flash vs pro: ~4x faster first token, faster decode
+    answer = "Supported by the first snippet [1]."
+    responses = [answer] * n_cases
+    return {
+        "fast": LatencyFakeChatModel(responses=responses, ttft=0.25, sleep=0.002),
+        "strong": LatencyFakeChatModel(responses=responses, ttft=1.0, sleep=0.006),
+    }
+
+
+def _citations_valid(answer: str, n_docs: int) -> bool:
+    return all(1 <= int(n) <= n_docs for n in _CITE_RE.findall(answer))
+
+
+def _overlap(a: str, b: str) -> float:
+    ta, tb = set(a.lower().split()), set(b.lower().split())
+    return len(ta & tb) / len(ta | tb) if (ta | tb) else 1.0
+
+
+def _chunk_text(chunk: Any) -> str:
+    """Plain text of a streamed chunk (same coercion as the chat UI)."""
+    if chunk is None:
+        return ""
+    if isinstance(chunk, str):
+        return chunk
+    content = getattr(chunk, "content", chunk)
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):  # content blocks
+        return "".join(
+            b if isinstance(b, str) else str(b.get("text", ""))
+            for b in content
+            if isinstance(b, (str, dict))
+        )
+    if isinstance(content, dict):
+        return _chunk_text(content.get("text") or content.get("content"))
+    return ""
+
+
+def _run(chain: Any, question: str, context: str) -> Dict[str, Any]:
+    t0 = time.perf_counter()
+    ttft: Optional[float] = None
+    parts: List[str] = []
+    inputs = {"question": question, "context": context, "history": ""}
+    for chunk in chain.stream(inputs):
+        token = _chunk_text(chunk)
+        if not token:
+            continue  # e.g. Gemini's final empty chunk carrying usage metadata
+        if ttft is None:
+            ttft = time.perf_counter() - t0
+        parts.append(token)
+    total = time.perf_counter() - t0
+    return {"ttft": ttft or total, "total": total, "answer": "".join(parts)}
+
+
+def evaluate(cases: List[Dict[str, Any]], llms: Dict[str, Any]) -> Dict[str, Any]:
+    chains = build_routed_chains(llms, build_streaming_chain)
+    results: Dict[str, List[Dict[str, Any]]] = {"strong_only": [], "routed": []}
+    routes: Dict[str, int] = {"fast": 0, "strong": 0}
+
+    for case in cases:
+        question, docs = case["question"], case.get("docs") or []
+        context = render_context(docs)
+        route = choose_route(question, docs, context)
+        routes[route] += 1
+
+        strong = _run(chains["strong"], question, context)
+        # Re-use the strong run when the router picks strong anyway
+        routed = (
+            strong if route == "strong" else _run(chains[route], question, context)
+        )
+        for name, r in (("strong_only", strong), ("routed", routed)):
+            r["citations_valid"] = _citations_valid(r["answer"], len(docs))
+            results[name].append(r)
+        routed["overlap_with_strong"] = _overlap(routed["answer"], strong["answer"])
+
+    summary: Dict[str, Any] = {"cases": len(cases), "routes": routes}
+    for name, rows in results.items():
+        if not rows:
+            continue
+        summary[name] = {
+            "ttft_mean_s": statistics.fmean(r["ttft"] for r in rows),
+            "total_mean_s": statistics.fmean(r["total"] for r in rows),
+            "citations_valid": sum(r["citations_valid"] for r in rows) / len(rows),
+        }
+    if results["routed"]:
+        summary["routed"]["overlap_with_strong"] = statistics.fmean(
+            r["overlap_with_strong"] for r in results["routed"]
+        )
+    return summary
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m app.route_eval")
+    parser.add_argument("cases", help="JSONL of {question, docs}")
+    parser.add_argument("--live", action="store_true", help="use real Gemini models")
+    args = parser.parse_args(argv)
+
+    with open(args.cases, encoding="utf-8") as f:
+        cases = [json.loads(line) for line in f if line.strip()]
+
+    if args.live:
+        from .clients import get_llms
+
+        llms = get_llms()
+    else:
+        llms = fake_llms(len(cases))
+    print(json.dumps(evaluate(cases, llms), indent=2))
+
+
+if __name__ == "__main__":
+    main()
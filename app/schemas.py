@@ -8,6 +8,9 @@ class QueryRequest(BaseModel):
     k: int = Field(25, ge=1, le=200)
     # docs to keep after rerank
     top_k: int = Field(5, ge=1, le=50)
+    # deep retrieval: page through up to this many docs, reranking as pages
+    # arrive (ignores k; capped server-side by DEEP_MAX_K)
+    deep_k: Optional[int] = Field(None, ge=1, le=5000)
 
 
 class SourceItem(BaseModel):
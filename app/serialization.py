@@ -0,0 +1,253 @@
+# app/serialization.py
+"""
+JSON encode/decode for the hot paths (reranker payloads, OpenSearch
+bodies/responses, `message` parsing, /query responses).
+
+orjson is used when installed; output is byte-identical to
+json.dumps(obj, ensure_ascii=False, separators=(",", ":")) — the format
+httpx, opensearch-py and Starlette emit. Where orjson would differ
+(exponent floats, NaN/inf, non-str keys, >64-bit ints) we fall back to
+the stdlib for that call.
+"""
+import os
+import json
+import gzip
+import math
+import time
+from typing import Any, Dict, Tuple, Union
+
+from fastapi.responses import JSONResponse
+from opensearchpy.serializer import JSONSerializer  # type: ignore
+from opensearchpy.exceptions import SerializationError  # type: ignore
+
+try:
+    import orjson  # type: ignore
+
+    _HAS_ORJSON = True
+except Exception:
+    _HAS_ORJSON = False
+
+try:
+    import msgspec  # type: ignore
+
+    _HAS_MSGSPEC = True
+except Exception:
+    _HAS_MSGSPEC = False
+
+# -----------------------
+# Environment / Defaults
+# -----------------------
+JSON_BACKEND = os.getenv("JSON_BACKEND", "orjson")  # orjson | stdlib
+_FAST = _HAS_ORJSON and JSON_BACKEND == "orjson"
+
+JSON_MIME = "application/json"
+MSGPACK_MIME = "application/msgpack"
+
+
+# -----------------------
+# JSON
+# -----------------------
+def _orjson_safe(obj: Any) -> bool:
+    """
+    True when orjson renders `obj` exactly like the stdlib. Only floats need
+    checking here; other mismatches make orjson raise, which we catch.
+    Below 1e-4 and from 1e16 up the two pick different exponent styles.
+    """
+    if isinstance(obj, float):
+        return obj == 0.0 or (math.isfinite(obj) and 1e-4 <= abs(obj) < 1e16)
+    if isinstance(obj, dict):
+        return all(_orjson_safe(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return all(_orjson_safe(v) for v in obj)
+    return True
+
+
+def _stdlib_dumps(obj: Any, default: Any = None) -> bytes:
+    return json.dumps(
+        obj, default=default, ensure_ascii=False, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def dumps(obj: Any, default: Any = None) -> bytes:
+    """Compact UTF-8 JSON bytes."""
+    if _FAST and _orjson_safe(obj):
+        try:
+            return orjson.dumps(
+                obj, default=default, option=orjson.OPT_PASSTHROUGH_DATETIME
+            )
+        except TypeError:
+            pass
+    return _stdlib_dumps(obj, default)
+
+
+def loads(s: Union[str, bytes, bytearray, memoryview]) -> Any:
+    """Parse JSON; the stdlib handles inputs orjson rejects (NaN, huge ints)."""
+    if _FAST:
+        try:
+            return orjson.loads(s)
+        except ValueError:
+            pass
+    if isinstance(s, memoryview):
+        s = s.tobytes()
+    return json.loads(s)
+
+
+# -----------------------
+# OpenSearch client serializer
+# -----------------------
+class FastJSONSerializer(JSONSerializer):
+    """Drop-in for opensearch-py's default serializer (pass as serializer=...)."""
+
+    def dumps(self, data: Any) -> Union[str, bytes]:
+        if isinstance(data, (str, bytes)):
+            return data  # pre-serialized, e.g. a _bulk NDJSON body
+        try:
+            return dumps(data, default=self.default).decode("utf-8")
+        except (ValueError, TypeError) as e:
+            raise SerializationError(data, e)
+
+    def loads(self, s: Any) -> Any:
+        try:
+            return loads(s)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(s, e)
+
+
+# -----------------------
+# Reranker wire format
+# -----------------------
+def accept_header() -> str:
+    return f"{MSGPACK_MIME}, {JSON_MIME}" if _HAS_MSGSPEC else JSON_MIME
+
+
+def encode_body(obj: Any, encoding: str) -> Tuple[bytes, Dict[str, str]]:
+    """
+    Encode a request body as `json`, `gzip` (gzipped JSON) or `msgpack`.
+    Unavailable encodings degrade to plain JSON.
+    """
+    headers = {"Accept": accept_header()}
+    if encoding == "msgpack" and _HAS_MSGSPEC:
+        headers["Content-Type"] = MSGPACK_MIME
+        return msgspec.msgpack.encode(obj), headers
+
+    body = dumps(obj)
+    headers["Content-Type"] = JSON_MIME
+    if encoding == "gzip":
+        headers["Content-Encoding"] = "gzip"
+        # Level 1: most of the size win on prose, a fraction of the CPU
+        return gzip.compress(body, compresslevel=1, mtime=0), headers
+    return body, headers
+
+
+def decode_body(content: bytes, content_type: str) -> Any:
+    """Decode a response by its Content-Type (httpx already undid gzip)."""
+    if MSGPACK_MIME in (content_type or "") and _HAS_MSGSPEC:
+        return msgspec.msgpack.decode(content)
+    return loads(content)
+
+
+# -----------------------
+# FastAPI
+# -----------------------
+class FastJSONResponse(JSONResponse):
+    """JSONResponse with the fast encoder; same bytes as Starlette's render()."""
+
+    def render(self, content: Any) -> bytes:
+        if _FAST and _orjson_safe(content):
+            try:
+                return orjson.dumps(content)
+            except TypeError:
+                pass
+        # Starlette's own path (also keeps its allow_nan=False error)
+        return super().render(content)
+
+
+# -----------------------
+# Benchmark: python -m app.serialization
+# -----------------------
+def _bench() -> None:
+    import random
+
+    rng = random.Random(0)
+    words = [f"token{i}" for i in range(3000)] + ["café", "β-lactam", "IL-6"]
+
+    def abstract() -> str:
+        return " ".join(rng.choices(words, k=220))
+
+    rerank_payload = {
+        "query": "beta-lactam allergy cross reactivity",
+        "candidates": [abstract() for _ in range(200)],
+        "top_k": 10,
+    }
+    search_response = {
+        "took": 12,
+        "hits": {
+            "hits": [
+                {
+                    "_id": str(i),
+                    "_score": 20.0 - i * 0.05,
+                    "_source": {
+                        "PMID": 30000000 + i,
+                        "title": f"Title {i}",
+                        "message": json.dumps({"abstract": abstract()}),
+                    },
+                }
+                for i in range(200)
+            ]
+        },
+    }
+    search_raw = _stdlib_dumps(search_response)
+    message = search_response["hits"]["hits"][0]["_source"]["message"]
+    query_response = {
+        "answer": abstract(),
+        "sources": [
+            {
+                "id": str(i),
+                "score": 0.9 - i * 0.01,
+                "title": f"T{i}",
+                "text": abstract()[:250],
+            }
+            for i in range(10)
+        ],
+    }
+
+    def timeit(fn, n: int) -> float:
+        t0 = time.perf_counter()
+        for _ in range(n):
+            fn()
+        return (time.perf_counter() - t0) / n * 1e6
+
+    cases = [
+        (
+            "rerank payload encode (200 abstracts)",
+            lambda: _stdlib_dumps(rerank_payload),
+            lambda: dumps(rerank_payload),
+            200,
+        ),
+        (
+            "search response decode (200 hits)",
+            lambda: json.loads(search_raw),
+            lambda: loads(search_raw),
+            200,
+        ),
+        ("message parse", lambda: json.loads(message), lambda: loads(message), 5000),
+        (
+            "/query response render (10 sources)",
+            lambda: _stdlib_dumps(query_response),
+            lambda: dumps(query_response),
+            2000,
+        ),
+    ]
+    print(f"backend={'orjson' if _FAST else 'stdlib'} msgspec={_HAS_MSGSPEC}")
+    for name, slow, fast, n in cases:
+        assert slow() == fast(), f"{name}: fast path output differs"
+        s_us, f_us = timeit(slow, n), timeit(fast, n)
+        print(f"{name:>38}: stdlib {s_us:8.1f}us  fast {f_us:8.1f}us  x{s_us / f_us:.1f}")
+
+    raw = dumps(rerank_payload)
+    gz, _ = encode_body(rerank_payload, "gzip")
+    print(f"{'rerank payload size':>38}: json {len(raw)}B  gzip {len(gz)}B")
+
+
+if __name__ == "__main__":
+    _bench()
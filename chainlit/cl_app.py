@@ -7,29 +7,61 @@ import chainlit as cl
 from typing import Optional, List, Dict, Any
 
 # --- Reuse your app logic directly (no HTTP hop) ---
-from app.clients import get_os_client, get_llm, get_http_client
-from app.retrieval import os_search, call_reranker
+from app.clients import (
+    get_os_client,
+    get_llms,
+    get_http_client,
+    get_local_index,
+    get_reranker,
+)
+from app.retrieval import hybrid_search
+from app.dedup import collapse_duplicates, search_deduped, DEDUP_ENABLED
+from app.deep_retrieval import deep_retrieve_and_rerank
+from app.rerankers import served_by
+from app.admission import Admission, AdmissionRejected, PRIORITY_INTERACTIVE
+from app.candidate_pool import (
+    POOL_STATS,
+    POOL_TOPUP_K,
+    plan_reuse,
+    needs_topup,
+    merge_candidates,
+    build_pool,
+    reselect,
+)
+from chainlit.server import app as cl_server, is_thread_author
+from chainlit.auth import get_current_user
+from chainlit.data import get_data_layer
+from fastapi import Depends, HTTPException
 from app.chain import (
     build_streaming_chain,
     build_clarifier_chain,
+    build_routed_chains,
+    choose_route,
     render_context,
-)  # build_streaming_chain should support .stream()
+)  # build_streaming_chain should support .astream()
 
 # --- Data layer: enabled when env is set ---
 import boto3
-from chainlit.data.dynamodb import DynamoDBDataLayer
 from chainlit.data.storage_clients.s3 import S3StorageClient
+from app.data_layer import WriteBehindDataLayer, OFFLOAD_URL
 
 AWS_REGION = os.getenv("AWS_REGION", "us-east-1")
 CHAINLIT_TABLE = os.environ["CHAINLIT_TABLE"]  # required
 CHAINLIT_BUCKET = os.environ["CHAINLIT_BUCKET"]  # required
+# Point at local stand-ins (DynamoDB Local, MinIO/LocalStack) for testing
+DYNAMODB_ENDPOINT_URL = os.getenv("DYNAMODB_ENDPOINT_URL") or None
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
 
 
 @cl.data_layer
 def init_data_layer():
-    dynamo = boto3.client("dynamodb", region_name=AWS_REGION)
-    storage = S3StorageClient(bucket=CHAINLIT_BUCKET, region_name=AWS_REGION)
-    return DynamoDBDataLayer(
+    dynamo = boto3.client(
+        "dynamodb", region_name=AWS_REGION, endpoint_url=DYNAMODB_ENDPOINT_URL
+    )
+    storage = S3StorageClient(
+        bucket=CHAINLIT_BUCKET, region_name=AWS_REGION, endpoint_url=S3_ENDPOINT_URL
+    )
+    return WriteBehindDataLayer(
         table_name=CHAINLIT_TABLE,
         client=dynamo,
         storage_provider=storage,
@@ -44,13 +76,60 @@ SESSION_ID = os.getenv("SESSION_ID", str(uuid.uuid4()))
 CHAT_HISTORY_TURNS = int(os.getenv("CHAT_HISTORY_TURNS", "6"))  # last N turns to send
 ALWAYS_RAG = os.getenv("ALWAYS_RAG", "false").lower() == "true"  # bypass clarifier
 READY_PREFIX = os.getenv("READY_PREFIX", "READY:")
+DEEP_K = int(os.getenv("DEEP_K", "0"))  # >0: deep paged retrieval over this many candidates
 
 # --- Singletons reused by steps ---
 os_client = get_os_client()
-llm = get_llm()
-chain = build_streaming_chain(llm)
-clarifier = build_clarifier_chain(llm)
+local_index = get_local_index()  # optional hot-set tier (LOCAL_INDEX_PATH)
+reranker = get_reranker()  # RERANKER_BACKEND: http | cpu | router
+llms = get_llms()  # {"fast": ..., "strong": ...}
+chains = build_routed_chains(llms, build_streaming_chain)
+clarifier = build_clarifier_chain(llms["fast"])
 http = None  # async HTTP client for reranker
+admission = Admission()  # per-upstream limits + per-user fair queuing
+
+
+def _api_get(path: str):
+    """
+    cl_server.get, but registered ahead of Chainlit's catch-all
+    `GET /{full_path:path}`, which would otherwise answer with the SPA.
+    """
+
+    def register(fn):
+        cl_server.get(path)(fn)
+        routes = cl_server.router.routes
+        routes.insert(0, routes.pop())
+        return fn
+
+    return register
+
+
+@_api_get(OFFLOAD_URL)
+async def offloaded_output(
+    thread_id: str, step_id: str, current_user=Depends(get_current_user)
+):
+    """Full output of a step the data layer offloaded to S3 (fetched on open)."""
+    await is_thread_author(current_user.identifier, thread_id)
+    layer = get_data_layer()
+    if not isinstance(layer, WriteBehindDataLayer):
+        raise HTTPException(status_code=404, detail="No offloaded outputs")
+    key = layer.offload_key({"threadId": thread_id, "id": step_id})
+    try:
+        return await layer.load_offloaded(key)
+    except Exception:
+        raise HTTPException(status_code=404, detail="Output not found")
+
+
+@_api_get("/metrics/admission")
+def admission_metrics():
+    """Queue depth, active slots and wait-time stats per upstream."""
+    return admission.snapshot()
+
+
+@_api_get("/metrics/candidate_pool")
+def candidate_pool_metrics():
+    """How often follow-up turns reused the previous turn's candidates."""
+    return POOL_STATS
 
 
 def _cap(n: int, lo: int, hi: int) -> int:
@@ -119,6 +198,14 @@ def _render_sources_elements(sources: List[Dict[str, Any]]) -> List[cl.Text]:
     return items
 
 
+def _user_key() -> str:
+    """Fair-queuing identity: the logged-in user, else this chat session."""
+    user = cl.user_session.get("user")
+    if user is not None and getattr(user, "identifier", None):
+        return f"user:{user.identifier}"
+    return f"session:{cl.user_session.get('id')}"
+
+
 def _format_history(history: List[Dict[str, str]], turns: int) -> str:
     """Return a compact text view of the last N user+assistant turns."""
     trimmed = history[-(turns * 2) :] if turns > 0 else []
@@ -130,6 +217,139 @@ def _format_history(history: List[Dict[str, str]], turns: int) -> str:
     return "\n".join(lines)
 
 
+async def _search_step(query: str, k: int) -> Optional[List[Dict[str, Any]]]:
+    """STEP 1: SEARCH (show ALL docs passed to reranker). None on error."""
+    with cl.Step(name="Search") as search_step:
+        search_step.input = {"query": query, "k": k}
+        try:
+            async with admission.slot("opensearch", _user_key(), PRIORITY_INTERACTIVE):
+                raw, found, removed = await anyio.to_thread.run_sync(
+                    search_deduped, hybrid_search, os_client, local_index, query, k
+                )
+            # The full list: the data layer gzips it to S3 and persists only
+            # compact refs, served back in full when the step is reopened.
+            candidates = [_to_source_shape(doc) for doc in raw]
+            search_step.metadata = {
+                "candidates_found": found,
+                "duplicates_removed": removed,
+            }
+            search_step.output = {"candidates": candidates}
+        except Exception as e:
+            search_step.output = {"error": str(e)}
+            await cl.Message(content=f"Search error: {e}").send()
+            return None
+    return raw
+
+
+async def _pool_step(
+    query: str, pool: Dict[str, Any], top_k: int
+) -> Optional[List[Dict[str, Any]]]:
+    """
+    Follow-up turn: start from the previous turn's candidates instead of a
+    full search, topping up with a small search only for new query terms.
+    """
+    with cl.Step(name="Search (reused)") as search_step:
+        search_step.input = {"query": query, "pooled_query": pool["query"]}
+        try:
+            raw = list(pool["candidates"])
+            extra: List[Dict[str, Any]] = []
+            if needs_topup(pool, query, top_k):
+                POOL_STATS["topups"] += 1
+                async with admission.slot("opensearch", _user_key(), PRIORITY_INTERACTIVE):
+                    extra = await anyio.to_thread.run_sync(
+                        hybrid_search, os_client, local_index, query, POOL_TOPUP_K
+                    )
+                raw = merge_candidates(raw, extra)
+                if DEDUP_ENABLED:
+                    raw, _ = await anyio.to_thread.run_sync(collapse_duplicates, raw)
+            POOL_STATS["reranked"] += 1
+            search_step.metadata = {
+                "reused": len(pool["candidates"]),
+                "topup_hits": len(extra),
+            }
+            search_step.output = {"candidates": [_to_source_shape(d) for d in raw]}
+        except Exception as e:
+            search_step.output = {"error": str(e)}
+            await cl.Message(content=f"Search error: {e}").send()
+            return None
+    return raw
+
+
+def _reselect_step(pool: Dict[str, Any], top_k: int) -> List[Dict[str, Any]]:
+    """Same query terms as last turn: reuse the cached rerank, no upstream calls."""
+    with cl.Step(name="Rerank (cached)") as rerank_step:
+        rerank_step.input = {"top_k": top_k}
+        reranked = reselect(pool, top_k)
+        POOL_STATS["reselected"] += 1
+        reranked_view = [_to_source_shape(doc) for doc in reranked]
+        rerank_step.metadata = {"returned": len(reranked_view), "cached": True}
+        rerank_step.output = {"results": reranked_view}
+    return reranked
+
+
+async def _rerank_step(
+    query: str, raw: List[Dict[str, Any]], top_k: int
+) -> Optional[List[Dict[str, Any]]]:
+    """STEP 2: RERANK. None on error."""
+    with cl.Step(name="Rerank") as rerank_step:
+        rerank_step.input = {"top_k": top_k}
+        try:
+            served_by.set("")
+            async with admission.slot(reranker.admission_upstream, _user_key(), PRIORITY_INTERACTIVE):
+                if http is None:
+                    # Safety fallback
+                    temp_http = get_http_client()
+                    reranked = await reranker.rerank(temp_http, query, raw, top_k)
+                    await temp_http.aclose()
+                else:
+                    reranked = await reranker.rerank(http, query, raw, top_k)
+            reranked_view = [_to_source_shape(doc) for doc in reranked]
+            rerank_step.metadata = {
+                "backend": reranker.name,
+                # router: "http", or "cpu:<scorer>" when it spilled
+                "served_by": served_by.get() or reranker.label(),
+                "returned": len(reranked_view),
+                "top_titles": [s.get("title") or "Untitled" for s in reranked_view[:5]],
+            }
+            rerank_step.output = {"results": reranked_view}
+        except Exception as e:
+            rerank_step.output = {"error": str(e)}
+            await cl.Message(content=f"Reranker error: {e}").send()
+            return None
+    return reranked
+
+
+async def _deep_retrieval_step(
+    query: str, top_k: int
+) -> Optional[List[Dict[str, Any]]]:
+    """
+    Deep mode (DEEP_K > 0): page through up to DEEP_K candidates, reranking
+    each page as the next is fetched. Replaces the Search + Rerank steps.
+    """
+    with cl.Step(name="Deep retrieval") as deep_step:
+        deep_step.input = {"query": query, "max_candidates": DEEP_K, "top_k": top_k}
+        try:
+            client = http or get_http_client()
+            user = _user_key()
+            try:
+                async with admission.slot("opensearch", user, PRIORITY_INTERACTIVE):
+                    async with admission.slot(reranker.admission_upstream, user, PRIORITY_INTERACTIVE):
+                        reranked, stats = await deep_retrieve_and_rerank(
+                            os_client, reranker, client, query, top_k, DEEP_K
+                        )
+            finally:
+                if client is not http:
+                    await client.aclose()
+            reranked_view = [_to_source_shape(doc) for doc in reranked]
+            deep_step.metadata = {"backend": reranker.name, **stats}
+            deep_step.output = {"results": reranked_view}
+        except Exception as e:
+            deep_step.output = {"error": str(e)}
+            await cl.Message(content=f"Retrieval error: {e}").send()
+            return None
+    return reranked
+
+
 @cl.on_chat_start
 async def on_chat_start():
     """Warm up dependencies and greet."""
@@ -157,6 +377,14 @@ async def on_chat_end():
         http = None
 
 
+@cl.on_app_shutdown
+async def on_app_shutdown():
+    """Drain queued writes: Chainlit exits without closing the data layer."""
+    layer = get_data_layer()
+    if layer is not None:
+        await layer.close()
+
+
 @cl.password_auth_callback
 def auth(username: str, password: str) -> Optional[cl.User]:
     """Optional simple password auth (set CHAINLIT_ADMIN_PASSWORD)."""
@@ -175,6 +403,7 @@ async def on_message(message: cl.Message):
                         Users can also force with "/rag <query>".
       Step 1 (Search): show ALL retriever candidates (input to reranker)
       Step 2 (Rerank): show reranked set
+                       (with DEEP_K set, one "Deep retrieval" step instead)
       Then: stream final answer in a single bubble, and render Sources below
     """
     q = (message.content or "").strip()
@@ -199,9 +428,13 @@ async def on_message(message: cl.Message):
         do_search = True
     elif not ALWAYS_RAG:
         try:
-            clarifier_out = clarifier.invoke(
-                {"question": q, "history": history_text}
-            ).strip()
+            async with admission.slot("llm", _user_key(), PRIORITY_INTERACTIVE):
+                clarifier_out = (
+                    await clarifier.ainvoke({"question": q, "history": history_text})
+                ).strip()
+        except AdmissionRejected as e:
+            await cl.Message(content=f"Busy right now, please retry: {e.detail}").send()
+            return
         except Exception:
             clarifier_out = ""
         if clarifier_out.startswith(READY_PREFIX):
@@ -226,84 +459,77 @@ async def on_message(message: cl.Message):
         await cl.Message(content="Could you clarify a bit more?").send()
         return
 
-    # ---- STEP 1: SEARCH (show ALL docs passed to reranker) ----
-    with cl.Step(name="Search") as search_step:
-        search_step.input = {"query": final_query, "k": k}
-        try:
-            raw: List[Dict[str, Any]] = await anyio.to_thread.run_sync(
-                os_search, os_client, final_query, k
-            )
-            # Emit *all* candidates in the step output (primitives only)
-            candidates = [_to_source_shape(doc) for doc in raw]
-            search_step.metadata = {"candidates_found": len(candidates)}
-            search_step.output = {"candidates": candidates}
-        except Exception as e:
-            search_step.output = {"error": str(e)}
-            await cl.Message(content=f"Search error: {e}").send()
-            return
-
-    if not raw:
+    # ---- RETRIEVE: Search + Rerank steps (or one Deep retrieval step) ----
+    if DEEP_K > 0:
+        reranked = await _deep_retrieval_step(final_query, top_k)
+    else:
+        # Follow-ups that overlap the last query reuse its candidate pool
+        pool = cl.user_session.get("candidate_pool")
+        reuse = plan_reuse(pool, final_query, top_k)
+        POOL_STATS["turns"] += 1
+        if reuse == "reselect":
+            reranked = _reselect_step(pool, top_k)
+        else:
+            if reuse == "rerank":
+                raw = await _pool_step(final_query, pool, top_k)
+            else:
+                POOL_STATS["fresh"] += 1
+                raw = await _search_step(final_query, k)
+            reranked = await _rerank_step(final_query, raw, top_k) if raw else raw
+            if raw and reranked:
+                cl.user_session.set(
+                    "candidate_pool", build_pool(final_query, raw, reranked)
+                )
+    if reranked is None:
+        return  # error already shown in the step + chat
+
+    if not reranked:
         await cl.Message(content="I couldn't find anything relevant.").send()
         # Persist this user message even if no results
         history.append({"role": "user", "content": q})
         cl.user_session.set("history", history)
         return
 
-    # ---- STEP 2: RERANK ----
-    with cl.Step(name="Rerank") as rerank_step:
-        rerank_step.input = {"top_k": top_k}
-        try:
-            if http is None:
-                # Safety fallback
-                temp_http = get_http_client()
-                reranked = await call_reranker(temp_http, final_query, raw, top_k)
-                await temp_http.aclose()
-            else:
-                reranked = await call_reranker(http, final_query, raw, top_k)
-            reranked_view = [_to_source_shape(doc) for doc in reranked]
-            rerank_step.metadata = {
-                "returned": len(reranked_view),
-                "top_titles": [s.get("title") or "Untitled" for s in reranked_view[:5]],
-            }
-            rerank_step.output = {"results": reranked_view}
-        except Exception as e:
-            rerank_step.output = {"error": str(e)}
-            await cl.Message(content=f"Reranker error: {e}").send()
-            return
-
     # ---- BUILD CONTEXT & STREAM ANSWER (NOT a step) ----
     context = render_context(reranked)
+    route = choose_route(final_query, reranked, context)
+    chain = chains[route]
 
     msg = cl.Message(
-        content="", author="Assistant", metadata={"session_id": SESSION_ID}
+        content="",
+        author="Assistant",
+        metadata={"session_id": SESSION_ID, "model_route": route},
     )
     await msg.send()
 
     streamed_any = False
     chunks: List[str] = []
+    answer_inputs = {"question": final_query, "context": context, "history": history_text}
     try:
-        for chunk in chain.stream(
-            {"question": final_query, "context": context, "history": history_text}
-        ):
-            token = _ensure_text(chunk)
-            if token:
-                await msg.stream_token(token)
-                streamed_any = True
-                chunks.append(token)
-    except Exception:
-        # Fallback to non-streaming
-        try:
-            full = chain.invoke(
-                {"question": final_query, "context": context, "history": history_text}
-            )
-            full_text = _ensure_text(full)
-            await msg.stream_token(full_text)
-            streamed_any = True
-            chunks = [full_text]
-        except Exception as e:
-            msg.content = f"LLM error: {e}"
-            await msg.update()
-            return
+        async with admission.slot("llm", _user_key(), PRIORITY_INTERACTIVE):
+            try:
+                async for chunk in chain.astream(answer_inputs):
+                    token = _ensure_text(chunk)
+                    if token:
+                        await msg.stream_token(token)
+                        streamed_any = True
+                        chunks.append(token)
+            except Exception:
+                # Fallback to non-streaming
+                try:
+                    full = await chain.ainvoke(answer_inputs)
+                    full_text = _ensure_text(full)
+                    await msg.stream_token(full_text)
+                    streamed_any = True
+                    chunks = [full_text]
+                except Exception as e:
+                    msg.content = f"LLM error: {e}"
+                    await msg.update()
+                    return
+    except AdmissionRejected as e:
+        msg.content = f"Busy right now, please retry: {e.detail}"
+        await msg.update()
+        return
 
     if not streamed_any:
         msg.content = "(No answer)"
@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("fastapi")
+
+from app.admission import (
+    AdmissionRejected,
+    FairLimiter,
+    PRIORITY_BATCH,
+    PRIORITY_INTERACTIVE,
+)
+
+
+def test_round_robin_across_users():
+    async def run():
+        lim = FairLimiter("t", limit=1, max_per_user=10)
+        order = []
+
+        async def work(user, n, priority=PRIORITY_BATCH):
+            async with lim.slot(user, priority):
+                order.append(f"{user}{n}")
+                await asyncio.sleep(0)
+
+        await lim.acquire("holder")
+        tasks = [asyncio.create_task(work("a", i)) for i in range(3)]
+        tasks.append(asyncio.create_task(work("b", 0)))
+        tasks.append(asyncio.create_task(work("c", 0, PRIORITY_INTERACTIVE)))
+        await asyncio.sleep(0)  # everyone queued
+        lim.release()
+        await asyncio.gather(*tasks)
+        return order, lim
+
+    order, lim = asyncio.run(run())
+    # Interactive first, then one batch request per user in turn
+    assert order == ["c0", "a0", "b0", "a1", "a2"]
+    assert lim.active == 0 and lim._waiting == 0
+
+
+def test_rejections():
+    async def run():
+        lim = FairLimiter("t", limit=1, max_queue=2, max_per_user=1, max_wait_ms=20)
+        await lim.acquire("holder")
+        waiter = asyncio.create_task(lim.acquire("a"))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as per_user:
+            await lim.acquire("a")
+        other = asyncio.create_task(lim.acquire("b"))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as full:
+            await lim.acquire("c")
+        results = await asyncio.gather(waiter, other, return_exceptions=True)
+        return lim, per_user.value, full.value, results
+
+    lim, per_user, full, results = asyncio.run(run())
+    assert per_user.status_code == 429
+    assert full.status_code == 503
+    assert all(isinstance(r, AdmissionRejected) for r in results)  # timed out
+    assert lim._waiting == 0 and not any(lim._queues.values())
+    assert lim.active == 1  # only the holder
+
+
+def test_slot_handed_over_as_wait_times_out(monkeypatch):
+    async def run():
+        lim = FairLimiter("t", limit=1)
+        await lim.acquire("holder")
+
+        async def racing_wait_for(fut, timeout):
+            lim.release()  # the holder hands this waiter its slot...
+            raise asyncio.TimeoutError  # ...just as the wait times out
+
+        monkeypatch.setattr(asyncio, "wait_for", racing_wait_for)
+        await lim.acquire("a")  # keeps the slot instead of a 503
+        assert lim.active == 1 and lim._waiting == 0
+        lim.release()
+        return lim
+
+    lim = asyncio.run(run())
+    assert lim.active == 0
+
+
+def test_cancelled_during_handover_passes_slot_on(monkeypatch):
+    async def run():
+        lim = FairLimiter("t", limit=1)
+        await lim.acquire("holder")
+        real_wait_for = asyncio.wait_for
+        gate = asyncio.Event()
+        calls = []
+
+        async def racing_wait_for(fut, timeout):
+            calls.append(fut)
+            if len(calls) == 1:  # "a"
+                await gate.wait()
+                lim.release()  # the holder hands "a" its slot...
+                raise asyncio.CancelledError  # ...just as "a" goes away
+            return await real_wait_for(fut, timeout)
+
+        monkeypatch.setattr(asyncio, "wait_for", racing_wait_for)
+        a = asyncio.create_task(lim.acquire("a"))
+        b = asyncio.create_task(lim.acquire("b"))
+        await asyncio.sleep(0)  # both queued, "a" first
+        gate.set()
+        with pytest.raises(asyncio.CancelledError):
+            await a
+        await b
+        return lim
+
+    lim = asyncio.run(run())
+    # "a" passed the slot on to "b" instead of leaking it
+    assert lim.active == 1 and lim._waiting == 0
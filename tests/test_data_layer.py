@@ -0,0 +1,143 @@
+import asyncio
+import gzip
+import json
+
+import pytest
+
+pytest.importorskip("chainlit")
+pytest.importorskip("fastapi")
+
+from app.data_layer import DynamoDBDataLayer, WriteBehindDataLayer
+
+
+class FakeDynamo:
+    """Stands in for the parent's writes; `fail[id]` failures per step first."""
+
+    def __init__(self):
+        self.writes = []
+        self.fail = {}
+
+    def patch(self, monkeypatch):
+        def fake(op):
+            async def write(layer, step_dict):
+                if self.fail.get(step_dict["id"], 0):
+                    self.fail[step_dict["id"]] -= 1
+                    raise RuntimeError("throttled")
+                self.writes.append((op, dict(step_dict)))
+
+            return write
+
+        monkeypatch.setattr(DynamoDBDataLayer, "create_step", fake("create"))
+        monkeypatch.setattr(DynamoDBDataLayer, "update_step", fake("update"))
+
+
+class FakeStorage:
+    def __init__(self):
+        self.objects = {}
+
+    async def upload_file(self, object_key, data, mime, overwrite):
+        self.objects[object_key] = data
+
+
+@pytest.fixture
+def dynamo(monkeypatch):
+    fake = FakeDynamo()
+    fake.patch(monkeypatch)
+    return fake
+
+
+def _run(test, **kwargs):
+    """Run `test(layer)` on a layer that only flushes when told to."""
+    kwargs.setdefault("flush_interval_ms", 60_000)
+
+    async def main():
+        layer = WriteBehindDataLayer(table_name="steps", client=object(), **kwargs)
+        try:
+            await test(layer)
+        finally:
+            if layer._flusher is not None:
+                layer._flusher.cancel()
+        return layer
+
+    return asyncio.run(main())
+
+
+def test_create_and_updates_coalesce(dynamo):
+    async def test(layer):
+        layer._enqueue({"id": "s1", "threadId": "t", "output": "a"}, "create")
+        layer._enqueue({"id": "s1", "output": "b"}, "update")
+        layer._enqueue({"id": "s2", "output": "c"}, "update")
+        await layer.flush()
+
+    layer = _run(test)
+    assert dynamo.writes == [
+        ("create", {"id": "s1", "threadId": "t", "output": "b"}),
+        ("update", {"id": "s2", "output": "c"}),
+    ]
+    assert layer.stats["queued"] == 2
+    assert layer.stats["coalesced"] == 1
+    assert layer.stats["written"] == 2
+
+
+def test_failed_write_is_retried_on_next_flush(dynamo):
+    dynamo.fail["s1"] = 1
+
+    async def test(layer):
+        layer._enqueue({"id": "s1", "output": "a"}, "create")
+        await layer.flush()
+        assert dynamo.writes == [] and "s1" in layer._pending
+        # A newer update lands on top of the re-queued create
+        layer._enqueue({"id": "s1", "output": "b"}, "update")
+        await layer.flush()
+
+    layer = _run(test)
+    assert dynamo.writes == [("create", {"id": "s1", "output": "b"})]
+    assert layer.stats["retried"] == 1 and layer.stats["written"] == 1
+    assert not layer._pending
+
+
+def test_write_dropped_after_max_retries(dynamo):
+    dynamo.fail["s1"] = 99
+
+    async def test(layer):
+        layer._enqueue({"id": "s1", "output": "a"}, "create")
+        for _ in range(3):
+            await layer.flush()
+
+    layer = _run(test, max_retries=2)
+    assert dynamo.writes == []
+    assert layer.stats["retried"] == 2 and layer.stats["dropped"] == 1
+    assert not layer._pending
+
+
+def test_large_output_offloaded_and_served_lazily(dynamo, monkeypatch):
+    storage = FakeStorage()
+    candidates = [{"id": str(i), "score": 1.0, "text": "x" * 100} for i in range(5)]
+    output = json.dumps({"candidates": candidates})
+
+    async def test(layer):
+        layer.storage_provider = storage
+        layer._enqueue({"id": "s1", "threadId": "t", "output": output}, "create")
+        await layer.flush()
+
+    layer = _run(test, offload_min_bytes=100)
+    key = "threads/t/steps/s1.json.gz"
+    assert json.loads(gzip.decompress(storage.objects[key])) == json.loads(output)
+
+    (op, written), = dynamo.writes
+    view = json.loads(written["output"])
+    assert view["candidates"] == [{"id": str(i), "score": 1.0} for i in range(5)]
+    assert view["offloaded"] == {"key": key, "bytes": len(output)}
+
+    async def get_thread(self, thread_id):
+        return {"id": thread_id, "steps": [written], "elements": []}
+
+    monkeypatch.setattr(DynamoDBDataLayer, "get_thread", get_thread)
+
+    async def reopen(layer):
+        thread = await layer.get_thread("t")
+        assert thread["steps"][0]["output"] == written["output"]  # not fetched
+        (element,) = thread["elements"]
+        assert element["forId"] == "s1" and element["url"] == "/offloaded/t/s1"
+
+    _run(reopen)
@@ -0,0 +1,68 @@
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("opensearchpy")
+
+from app import dedup
+from app.dedup import collapse_duplicates, search_deduped
+
+ABSTRACT = (
+    "randomized trial of empagliflozin in patients with heart failure and "
+    "reduced ejection fraction showed fewer hospitalizations and lower "
+    "cardiovascular mortality over a median follow up of sixteen months"
+)
+
+
+def _cand(id_, text, score=1.0, pmid=None, title=None):
+    return {"id": id_, "pmid": pmid, "title": title, "text": text, "score": score}
+
+
+def test_same_pmid_keeps_best_scored_in_place():
+    cands = [
+        _cand("a", "first copy", 0.2, pmid="1"),
+        _cand("b", "unrelated malaria vaccine", 0.9, pmid="2"),
+        _cand("c", "second copy, other text", 0.5, pmid="1"),
+    ]
+    kept, removed = collapse_duplicates(cands)
+    assert removed == 1
+    assert [c["id"] for c in kept] == ["b", "c"]
+
+
+def test_identical_normalized_text():
+    cands = [
+        _cand("a", "Heart  failure, outcomes!", 0.5),
+        _cand("b", "heart failure outcomes", 0.5, pmid="7"),
+    ]
+    kept, removed = collapse_duplicates(cands)
+    # Same score: the one with a PMID is the better representative
+    assert removed == 1 and kept[0]["id"] == "b"
+
+
+def test_near_duplicates_collapse_distinct_survive():
+    near = ABSTRACT + " overall"  # one extra shingle: at most one bin differs
+    other = "malaria vaccine efficacy in children under five in sub saharan africa"
+    cands = [_cand("a", ABSTRACT, 0.9), _cand("b", near, 0.8), _cand("c", other, 0.7)]
+    kept, removed = collapse_duplicates(cands)
+    assert removed == 1
+    assert [c["id"] for c in kept] == ["a", "c"]
+
+    kept, removed = collapse_duplicates(cands, threshold=1.01)
+    assert removed == 0 and len(kept) == 3
+
+
+def test_small_inputs():
+    assert collapse_duplicates([]) == ([], 0)
+    one = [_cand("a", "x")]
+    assert collapse_duplicates(one) == (one, 0)
+
+
+def test_search_deduped(monkeypatch):
+    cands = [_cand("a", ABSTRACT, 0.9), _cand("b", ABSTRACT, 0.1)]
+    search = lambda query, k: cands[:k]  # noqa: E731
+
+    kept, found, removed = search_deduped(search, "q", 10)
+    assert (len(kept), found, removed) == (1, 2, 1)
+
+    monkeypatch.setattr(dedup, "DEDUP_ENABLED", False)
+    kept, found, removed = search_deduped(search, "q", 10)
+    assert (len(kept), found, removed) == (2, 2, 0)
@@ -0,0 +1,126 @@
+import json
+import os
+from array import array
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("opensearchpy")
+
+from app.local_index import LocalIndex, ReloadingIndex, build_index, tokenize
+
+DOCS = [
+    {
+        "id": "1",
+        "pmid": "1",
+        "title": "Heart failure",
+        "text": "heart failure outcomes with sglt2",
+        "s3": None,
+    },
+    {
+        "id": "2",
+        "pmid": "2",
+        "title": "Kidney",
+        "text": "chronic kidney disease and heart",
+        "s3": {"key": "k2"},
+    },
+    {"id": "3", "pmid": "3", "title": None, "text": "malaria vaccine trial", "s3": None},
+]
+
+
+def _read(path, typecode):
+    out = array(typecode)
+    with open(path, "rb") as f:
+        out.frombytes(f.read())
+    return out
+
+
+def test_on_disk_layout(tmp_path):
+    path = str(tmp_path / "idx")
+    meta = build_index(path, DOCS)
+
+    assert sorted(os.listdir(path)) == [
+        "doclens.bin",
+        "docs.bin",
+        "docs.off",
+        "lexicon.json",
+        "meta.json",
+        "postings.bin",
+    ]
+    with open(os.path.join(path, "meta.json")) as f:
+        assert json.load(f) == meta
+    assert meta["n_docs"] == 3
+
+    # docs.off: n_docs + 1 uint64 offsets delimiting one JSON record per doc
+    offsets = _read(os.path.join(path, "docs.off"), "Q")
+    with open(os.path.join(path, "docs.bin"), "rb") as f:
+        blob = f.read()
+    assert len(offsets) == 4 and offsets[0] == 0 and offsets[-1] == len(blob)
+    records = [json.loads(blob[offsets[i] : offsets[i + 1]]) for i in range(3)]
+    assert records == DOCS
+
+    # doclens.bin: uint32 token count of title + text per doc
+    doclens = _read(os.path.join(path, "doclens.bin"), "I")
+    expected = [len(tokenize(f"{d['title'] or ''} {d['text']}")) for d in DOCS]
+    assert list(doclens) == expected
+    assert meta["avgdl"] == pytest.approx(sum(expected) / 3)
+
+    # lexicon: term -> [pair offset, df] into uint32 (doc, tf) postings
+    with open(os.path.join(path, "lexicon.json")) as f:
+        lexicon = json.load(f)
+    postings = _read(os.path.join(path, "postings.bin"), "I")
+    off, df = lexicon["heart"]
+    pairs = [tuple(postings[2 * i : 2 * i + 2]) for i in range(off, off + df)]
+    assert pairs == [(0, 2), (1, 1)]
+    assert sum(df for _, df in lexicon.values()) * 2 == len(postings)
+
+
+def test_search_and_coverage(tmp_path):
+    path = str(tmp_path / "idx")
+    build_index(path, DOCS)
+    index = LocalIndex.open(path)
+    try:
+        hits, coverage = index.search_with_coverage("heart failure", 10)
+        assert [h["id"] for h in hits] == ["1", "2"]
+        assert coverage == [1.0, 0.5]
+        assert hits[0]["s3"] is None and hits[1]["s3"] == {"key": "k2"}
+        assert index.search("the of", 10) == []
+    finally:
+        index.close()
+
+
+def test_incremental_upsert(tmp_path):
+    path = str(tmp_path / "idx")
+    build_index(path, DOCS)
+    build_index(path, [{**DOCS[0], "text": "replaced"}], incremental=True)
+    index = LocalIndex.open(path)
+    try:
+        docs = {d["id"]: d for d in index.iter_docs()}
+        assert sorted(docs) == ["1", "2", "3"]
+        assert docs["1"]["text"] == "replaced"
+    finally:
+        index.close()
+
+
+def test_empty_index(tmp_path):
+    path = str(tmp_path / "idx")
+    build_index(path, [])
+    index = LocalIndex.open(path)
+    try:
+        assert len(index) == 0
+        assert index.search("heart", 5) == []
+    finally:
+        index.close()
+
+
+def test_reloading_index_picks_up_rebuild(tmp_path):
+    path = str(tmp_path / "idx")
+    build_index(path, DOCS)
+    index = ReloadingIndex(path, check_every=0)
+    try:
+        assert len(index) == 3
+        build_index(path, DOCS[:1])
+        assert len(index) == 1
+        assert [h["id"] for h in index.search("kidney", 5)] == []
+    finally:
+        index.close()